@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Minimal in-process MQTT 3.1.1 broker for benchmarks. Enough of the protocol for paho:
+# CONNECT, PUBLISH (QoS 0/1), SUBSCRIBE/UNSUBSCRIBE with + and # wildcards, retained messages,
+# PINGREQ and DISCONNECT. Publish counts are kept per topic so runs can be compared.
+
+import asyncio
+import struct
+from collections import Counter
+
+
+def topic_matches(topic_filter, topic):
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for index, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if index >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[index]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        digit = length % 128
+        length //= 128
+        encoded.append(digit | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    encoded = value.encode("utf-8")
+    return struct.pack("!H", len(encoded)) + encoded
+
+
+class Session:
+    def __init__(self, writer):
+        self.writer = writer
+        self.subscriptions = []
+
+
+class MqttBroker:
+    def __init__(self):
+        self.sessions = set()
+        self.retained = {}
+        self.publish_counts = Counter()
+        self.publish_bytes = 0
+        self.listeners = []
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=1883):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for session in list(self.sessions):
+            session.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        session = Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                multiplier, length = 1, 0
+                while True:
+                    digit = (await reader.readexactly(1))[0]
+                    length += (digit & 127) * multiplier
+                    multiplier *= 128
+                    if not digit & 128:
+                        break
+                body = await reader.readexactly(length)
+                packet_type = header[0] >> 4
+
+                if packet_type == 1:
+                    writer.write(b"\x20\x02\x00\x00")
+                elif packet_type == 3:
+                    self.on_publish(writer, header[0], body)
+                elif packet_type == 8:
+                    self.on_subscribe(session, body)
+                elif packet_type == 10:
+                    self.on_unsubscribe(session, body)
+                elif packet_type == 12:
+                    writer.write(b"\xd0\x00")
+                elif packet_type == 14:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    def on_publish(self, writer, flags, body):
+        qos = (flags >> 1) & 3
+        retain = bool(flags & 1)
+        topic_length = struct.unpack("!H", body[:2])[0]
+        topic = body[2:2 + topic_length].decode("utf-8")
+        position = 2 + topic_length
+        if qos:
+            writer.write(b"\x40\x02" + body[position:position + 2])
+            position += 2
+        self.deliver(topic, body[position:], retain)
+
+    def on_subscribe(self, session, body):
+        packet_id, position, granted, filters = body[:2], 2, b"", []
+        while position < len(body):
+            length = struct.unpack("!H", body[position:position + 2])[0]
+            filters.append(body[position + 2:position + 2 + length].decode("utf-8"))
+            position += 3 + length
+            granted += b"\x00"
+        session.subscriptions.extend(filters)
+        session.writer.write(b"\x90" + encode_length(2 + len(granted)) + packet_id + granted)
+        for topic_filter in filters:
+            for topic, payload in list(self.retained.items()):
+                if topic_matches(topic_filter, topic):
+                    self.send(session.writer, topic, payload, retain=True)
+
+    def on_unsubscribe(self, session, body):
+        packet_id, position = body[:2], 2
+        while position < len(body):
+            length = struct.unpack("!H", body[position:position + 2])[0]
+            topic_filter = body[position + 2:position + 2 + length].decode("utf-8")
+            if topic_filter in session.subscriptions:
+                session.subscriptions.remove(topic_filter)
+            position += 2 + length
+        session.writer.write(b"\xb0\x02" + packet_id)
+
+    def send(self, writer, topic, payload, retain=False):
+        body = encode_string(topic) + payload
+        writer.write(bytes([0x30 | int(retain)]) + encode_length(len(body)) + body)
+
+    def deliver(self, topic, payload, retain=False):
+        self.publish_counts[topic] += 1
+        self.publish_bytes += len(payload)
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for listener in self.listeners:
+            listener(topic, payload)
+        for session in list(self.sessions):
+            if any(topic_matches(topic_filter, topic) for topic_filter in session.subscriptions):
+                self.send(session.writer, topic, payload)
+
+    # Publish as if from another client, e.g. Home Assistant sending a command
+    def publish(self, topic, payload, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.deliver(topic, payload, retain)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Standalone benchmark MQTT broker")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    async def main():
+        broker = MqttBroker()
+        port = await broker.start(port=args.port)
+        print(f"Listening on {port}")
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
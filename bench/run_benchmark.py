@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+# Offline benchmark for thermostat_api_server.py. Starts the in-process MQTT broker stand-in,
+# launches the server against it as a subprocess serving a fleet of simulated thermostats, drives
+# the fleet for a fixed duration and reports throughput, latency percentiles, server RSS and CPU,
+# and MQTT publish counts. Optionally plays Home Assistant sending setpoint commands and measures
+# how long they take to reach the thermostat, or exports samples to the webhook receiver stand-in.
+#
+#   python bench/run_benchmark.py --thermostats 50 --poll-interval 2 --duration 60
+#   python bench/run_benchmark.py --env SERVER_MODE=asyncio --json
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from mqtt_broker import MqttBroker
+from simulated_thermostat import SimulatedThermostat
+from webhook_receiver import WebhookReceiver
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "thermostat_api_server.py")
+# The server always listens on 8080
+SERVER_PORT = 8080
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.command_latencies = []
+        self.recording = False
+
+    def record(self, path, seconds):
+        if self.recording:
+            self.latencies[path].append(seconds)
+
+    def error(self, path):
+        self.errors[path] += 1
+
+    def command_applied(self, seconds):
+        if self.recording:
+            self.command_latencies.append(seconds)
+
+
+# Samples the server and any worker processes it forked
+class ProcessSampler:
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK")
+        self.rss = []
+
+    def pids(self):
+        pids = [self.pid]
+        try:
+            with open(f"/proc/{self.pid}/task/{self.pid}/children") as children:
+                pids.extend(int(pid) for pid in children.read().split())
+        except OSError:
+            pass
+        return pids
+
+    def read_rss(self):
+        total = None
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as status:
+                    for line in status:
+                        if line.startswith("VmRSS:"):
+                            total = (total or 0) + int(line.split()[1]) * 1024
+            except OSError:
+                pass
+        return total
+
+    def read_cpu(self):
+        total = None
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/stat") as stat:
+                    fields = stat.read().rsplit(")", 1)[1].split()
+                total = (total or 0) + (int(fields[11]) + int(fields[12])) / self.ticks
+            except (OSError, IndexError, ValueError):
+                pass
+        return total
+
+    async def run(self, interval=0.5):
+        while True:
+            rss = self.read_rss()
+            if rss is not None:
+                self.rss.append(rss)
+            await asyncio.sleep(interval)
+
+
+async def wait_for_server(host, port, process, timeout=15):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode}")
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(f"GET /Alive HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+            await reader.readuntil(b"\r\n\r\n")
+            writer.close()
+            return time.perf_counter()
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError("Server did not start listening")
+
+
+async def send_commands(broker, fleet, interval, stats):
+    while True:
+        await asyncio.sleep(interval)
+        thermostat = random.choice(fleet)
+        setpoint = thermostat.clsp + random.choice((-2, -1, 1, 2))
+        thermostat.pending_command = (setpoint, time.perf_counter())
+        broker.publish(f"homeassistant/climate/{thermostat.name}/cmnd/temperature", f"{setpoint}.0")
+
+
+def publish_summary(broker):
+    summary = defaultdict(int)
+    for topic, count in broker.publish_counts.items():
+        if topic.endswith("/state"):
+            summary["state"] += count
+        elif topic.endswith("/config"):
+            summary["discovery"] += count
+        elif "/cmnd/" in topic:
+            summary["command"] += count
+        else:
+            summary["other"] += count
+    return dict(summary)
+
+
+async def benchmark(args):
+    broker = MqttBroker()
+    broker_port = await broker.start(port=args.broker_port)
+    receiver = None
+    if args.webhook:
+        receiver = WebhookReceiver(args.webhook_delay, args.webhook_fail_every)
+        receiver_port = await receiver.start(port=0)
+
+    fleet_names = [(f"BENCH{index:05d}", f"Bench{index:05d}") for index in range(args.thermostats)]
+    env = dict(os.environ)
+    env.update({
+        "API_SERVER_ADDRESS": f"{args.host}:{SERVER_PORT}",
+        "MQTT_SERVER": "127.0.0.1",
+        "MQTT_PORT": str(broker_port),
+        "THERMOSTAT_SERIAL": fleet_names[0][0],
+        "THERMOSTAT_NAME": fleet_names[0][1],
+        "LOG_LEVEL": args.log_level,
+    })
+    if receiver is not None:
+        env["EXPORT_WEBHOOK"] = f"http://127.0.0.1:{receiver_port}/samples"
+    if args.thermostats > 1:
+        env["THERMOSTATS"] = ",".join(f"{serial}:{name}" for serial, name in fleet_names)
+    for override in args.env:
+        key, _, value = override.partition("=")
+        env[key] = value
+
+    launched = time.perf_counter()
+    process = subprocess.Popen([sys.executable, args.server], env=env)
+    sampler = ProcessSampler(process.pid)
+    try:
+        listening = await wait_for_server(args.host, SERVER_PORT, process)
+        sampling = asyncio.ensure_future(sampler.run())
+        # Let discovery settle so it doesn't count against the run
+        await asyncio.sleep(args.settle)
+
+        stats = Stats()
+        fleet = [SimulatedThermostat(serial, name, args.host, SERVER_PORT, args.poll_interval, stats, honor_ping_rate=not args.ignore_ping_rate) for serial, name in fleet_names]
+        rss_before = sampler.read_rss()
+
+        deadline = time.perf_counter() + args.warmup + args.duration
+        tasks = []
+        for thermostat in fleet:
+            tasks.append(asyncio.ensure_future(thermostat.run(deadline)))
+            # Spread boots over one poll interval like a real fleet
+            await asyncio.sleep(min(args.poll_interval, 1) / max(1, len(fleet)))
+        commands = asyncio.ensure_future(send_commands(broker, fleet, args.command_interval, stats)) if args.command_interval > 0 else None
+
+        await asyncio.sleep(max(0, deadline - args.duration - time.perf_counter()))
+        stats.recording = True
+        cpu_started = sampler.read_cpu()
+        publishes_started = dict(broker.publish_counts)
+        measured_from = time.perf_counter()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - measured_from
+        cpu_ended = sampler.read_cpu()
+        rss_ended = sampler.read_rss()
+        if commands is not None:
+            commands.cancel()
+        sampling.cancel()
+
+        run_publishes = MqttBroker()
+        for topic, count in broker.publish_counts.items():
+            run_publishes.publish_counts[topic] = count - publishes_started.get(topic, 0)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        await broker.stop()
+        if receiver is not None:
+            await receiver.stop()
+
+    all_latencies = [seconds for values in stats.latencies.values() for seconds in values]
+    return {
+        "thermostats": args.thermostats,
+        "poll_interval": args.poll_interval,
+        "duration": round(elapsed, 3),
+        "server_env": args.env,
+        "startup_ms": milliseconds(listening - launched),
+        "requests": len(all_latencies),
+        "throughput": round(len(all_latencies) / elapsed, 1),
+        "errors": dict(stats.errors),
+        "latency_ms": {
+            path: {
+                "count": len(values),
+                "p50": milliseconds(percentile(values, 0.5)),
+                "p99": milliseconds(percentile(values, 0.99)),
+                "max": milliseconds(max(values)),
+            }
+            for path, values in sorted(stats.latencies.items())
+        },
+        "overall_ms": {"p50": milliseconds(percentile(all_latencies, 0.5)), "p99": milliseconds(percentile(all_latencies, 0.99))},
+        "rss_mib": {
+            "idle": round(rss_before / 1048576, 1) if rss_before else None,
+            "peak": round(max(sampler.rss) / 1048576, 1) if sampler.rss else None,
+            "end": round(rss_ended / 1048576, 1) if rss_ended else None,
+        },
+        "cpu_seconds": round(cpu_ended - cpu_started, 3) if cpu_started is not None and cpu_ended is not None else None,
+        "cpu_percent": round(100 * (cpu_ended - cpu_started) / elapsed, 1) if cpu_started is not None and cpu_ended is not None else None,
+        "publishes": publish_summary(run_publishes),
+        "publishes_total": publish_summary(broker),
+        "publish_bytes": broker.publish_bytes,
+        "command_latency_ms": {
+            "count": len(stats.command_latencies),
+            "p50": milliseconds(percentile(stats.command_latencies, 0.5)),
+            "p99": milliseconds(percentile(stats.command_latencies, 0.99)),
+        },
+        "webhook": {"requests": receiver.requests, "batches": receiver.batches, "samples": sum(receiver.samples.values())} if receiver is not None else None,
+    }
+
+
+def print_report(result):
+    print(f"Thermostats: {result['thermostats']}  poll interval: {result['poll_interval']}s  measured: {result['duration']}s  env: {' '.join(result['server_env']) or '-'}")
+    print(f"Startup to first /Alive: {result['startup_ms']} ms")
+    print(f"Requests: {result['requests']} ({result['throughput']}/s)  errors: {sum(result['errors'].values())}")
+    print(f"  {'path':<20}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for path, latency in result["latency_ms"].items():
+        print(f"  {path:<20}{latency['count']:>8}{latency['p50']:>10}{latency['p99']:>10}{latency['max']:>10}")
+    print(f"  {'all':<20}{result['requests']:>8}{result['overall_ms']['p50']!s:>10}{result['overall_ms']['p99']!s:>10}")
+    rss = result["rss_mib"]
+    print(f"Server RSS MiB (including workers): idle {rss['idle']}  peak {rss['peak']}  end {rss['end']}")
+    print(f"Server CPU: {result['cpu_seconds']} s ({result['cpu_percent']}% of one core)")
+    print(f"MQTT publishes during run: {result['publishes']}  total: {result['publishes_total']}  bytes: {result['publish_bytes']}")
+    commands = result["command_latency_ms"]
+    if commands["count"]:
+        print(f"Command to applied: n={commands['count']}  p50 {commands['p50']} ms  p99 {commands['p99']} ms")
+    webhook = result["webhook"]
+    if webhook is not None:
+        print(f"Webhook: {webhook['samples']} samples in {webhook['batches']} batches ({webhook['requests']} requests)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thermostat_api_server.py with a simulated thermostat fleet")
+    parser.add_argument("--thermostats", type=int, default=10, help="fleet size")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between /status posts per thermostat, 0 polls back to back")
+    parser.add_argument("--duration", type=float, default=20.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds after the fleet boots")
+    parser.add_argument("--settle", type=float, default=1.5, help="seconds to wait for discovery before starting the fleet")
+    parser.add_argument("--command-interval", type=float, default=0.0, help="seconds between simulated Home Assistant setpoint commands, 0 disables")
+    parser.add_argument("--ignore-ping-rate", action="store_true", help="keep the configured poll interval even if the server advertises a pingRate")
+    parser.add_argument("--webhook", action="store_true", help="export samples to a local webhook receiver and count them")
+    parser.add_argument("--webhook-delay", type=float, default=0.0, help="seconds the webhook receiver takes to answer each batch")
+    parser.add_argument("--webhook-fail-every", type=int, default=0, help="webhook receiver answers every Nth batch with 503")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server environment, repeatable")
+    parser.add_argument("--server", default=SERVER)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--broker-port", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(benchmark(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
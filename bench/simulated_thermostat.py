@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# Simulated Observer TSTAT0201CW. Each instance keeps one keep-alive connection to the API
+# server and replays the thermostat's traffic: /time and /profile at boot, then /status every
+# poll, /odu_status and /equipment_events every few polls, and /config whenever the status reply
+# says configHasChanges. Request latencies are collected per path.
+
+import asyncio
+import random
+import re
+import time
+from urllib.parse import quote
+
+CONFIG_HAS_CHANGES = re.compile(rb"<configHasChanges>on</configHasChanges>")
+PING_RATE = re.compile(rb"<pingRate>(\d+)</pingRate>")
+CLSP = re.compile(rb"<clsp>([^<]*)</clsp>")
+HTSP = re.compile(rb"<htsp>([^<]*)</htsp>")
+MODE = re.compile(rb"<mode>([^<]*)</mode>")
+
+
+def form_body(xml):
+    return ("data=" + quote(xml)).encode("utf-8")
+
+
+def localtime():
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def status_xml(thermostat):
+    cooling = thermostat.mode == "cool" and thermostat.rt > thermostat.clsp
+    heating = thermostat.mode == "heat" and thermostat.rt < thermostat.htsp
+    return (
+        f'<status version="1.9" xmlns:atom="http://www.w3.org/2005/Atom">'
+        f'<atom:link rel="self" href="http://www.api.ing.carrier.com/systems/{thermostat.serial}/status"/>'
+        f'<localTime>{localtime()}</localTime><oat>{thermostat.oat}</oat><mode>{thermostat.mode}</mode>'
+        f'<cfgem>F</cfgem><cfgtype>heatcool</cfgtype><vacatrunning>off</vacatrunning>'
+        f'<filtrlvl>{thermostat.filtrlvl}</filtrlvl><uvlvl>255</uvlvl><humlvl>255</humlvl><ventlvl>255</ventlvl>'
+        f'<humid>off</humid><opstat>{"cool" if cooling else "heat" if heating else "off"}</opstat>'
+        f'<rt>{thermostat.rt}</rt><rh>{thermostat.rh}</rh><fan>{thermostat.fan}</fan>'
+        f'<coolicon>{"on" if cooling else "off"}</coolicon><heaticon>{"on" if heating else "off"}</heaticon>'
+        f'<fanicon>{"on" if cooling or heating else "off"}</fanicon><hold>{thermostat.hold}</hold>'
+        f'<clsp>{thermostat.clsp}</clsp><htsp>{thermostat.htsp}</htsp>'
+        f'<iducfm>{800 if cooling or heating else 0}</iducfm><oducoiltmp>{thermostat.oat + (12 if cooling else 0)}</oducoiltmp>'
+        f'<zones><zone id="1"><name>Zone 1</name><enabled>on</enabled><currentActivity>manual</currentActivity>'
+        f'<damperposition>15</damperposition><otmr/></zone></zones>'
+        f'<oprstsmsg>{"Cooling" if cooling else "Heating" if heating else "Idle"}</oprstsmsg></status>'
+    )
+
+
+def odu_status_xml(thermostat):
+    return (
+        f'<odu_status version="1.9" xmlns:atom="http://www.w3.org/2005/Atom">'
+        f'<localTime>{localtime()}</localTime><oducoiltmp>{thermostat.oat + 3}</oducoiltmp><oat>{thermostat.oat}</oat>'
+        f'<opstat>{thermostat.mode}</opstat><opmode>normal</opmode><iducfm>0</iducfm><lockout>off</lockout>'
+        f'<comprpm>0</comprpm><suctpress>125</suctpress><dischargetmp>0</dischargetmp></odu_status>'
+    )
+
+
+def equipment_events_xml(thermostat, events=20):
+    entries = []
+    for index in range(events):
+        active = "on" if index == 0 and thermostat.fault else "off"
+        entries.append(
+            f'<event id="{index}"><localtime>T{localtime()}</localtime><code>{100 + index}</code>'
+            f'<active>{active}</active><description>Simulated event {index}</description>'
+            f'<source>ODU</source><equipment>Heat Pump</equipment></event>'
+        )
+    return f'<equipment_events version="1.9" xmlns:atom="http://www.w3.org/2005/Atom">{"".join(entries)}</equipment_events>'
+
+
+def profile_xml(thermostat):
+    return (
+        f'<profile version="1.9" xmlns:atom="http://www.w3.org/2005/Atom"><model>TSTAT0201CW</model>'
+        f'<brand>Observer</brand><firmware>{thermostat.firmware}</firmware><serial>{thermostat.serial}</serial>'
+        f'<routerMac>00:00:00:00:00:00</routerMac></profile>'
+    )
+
+
+class SimulatedThermostat:
+    def __init__(self, serial, name, host, port, poll_interval, stats, odu_every=5, equipment_every=10, honor_ping_rate=True):
+        self.serial = serial
+        self.name = name
+        self.host = host
+        self.port = port
+        self.poll_interval = poll_interval
+        self.stats = stats
+        self.odu_every = odu_every
+        self.equipment_every = equipment_every
+        self.honor_ping_rate = honor_ping_rate
+
+        self.mode = "cool"
+        self.fan = "auto"
+        self.hold = "on"
+        self.clsp = random.randint(72, 76)
+        self.htsp = random.randint(64, 68)
+        self.rt = random.randint(70, 78)
+        self.rh = random.randint(35, 55)
+        self.oat = random.randint(60, 95)
+        self.filtrlvl = random.randint(0, 100)
+        self.firmware = "03.51.00"
+        self.fault = random.random() < 0.1
+
+        # (setpoint, sent at) for the last command Home Assistant sent this thermostat
+        self.pending_command = None
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=b""):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+        if method == "POST":
+            head += f"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {len(body)}\r\n"
+        started = time.perf_counter()
+        try:
+            self.writer.write((head + "\r\n").encode("latin-1") + body)
+            response_head = await self.reader.readuntil(b"\r\n\r\n")
+            length = int(re.search(rb"Content-Length: (\d+)", response_head).group(1))
+            reply = await self.reader.readexactly(length) if length else b""
+        except (OSError, asyncio.IncompleteReadError, AttributeError):
+            self.stats.error(path)
+            self.writer.close()
+            self.writer = None
+            return None
+        self.stats.record(path.rsplit("/", 1)[-1] or path, time.perf_counter() - started)
+        return reply
+
+    def apply_config(self, reply):
+        for pattern, attribute in ((CLSP, "clsp"), (HTSP, "htsp")):
+            match = pattern.search(reply)
+            if match:
+                try:
+                    setattr(self, attribute, int(float(match.group(1))))
+                except ValueError:
+                    pass
+        match = MODE.search(reply)
+        if match:
+            self.mode = match.group(1).decode()
+        if self.pending_command is not None and self.pending_command[0] == self.clsp:
+            self.stats.command_applied(time.perf_counter() - self.pending_command[1])
+            self.pending_command = None
+
+    def drift(self):
+        self.rt += random.choice((-1, 0, 0, 1))
+        self.rt = max(60, min(90, self.rt))
+
+    async def run(self, deadline):
+        await self.request("GET", "/time")
+        await self.request("POST", f"/systems/{self.serial}/profile", form_body(profile_xml(self)))
+        polls = 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            polls += 1
+            self.drift()
+
+            interval = self.poll_interval
+            reply = await self.request("POST", f"/systems/{self.serial}/status", form_body(status_xml(self)))
+            if reply is not None:
+                if CONFIG_HAS_CHANGES.search(reply):
+                    config = await self.request("GET", f"/systems/{self.serial}/config")
+                    if config:
+                        self.apply_config(config)
+                match = PING_RATE.search(reply)
+                if self.honor_ping_rate and match and int(match.group(1)) > 0:
+                    interval = int(match.group(1))
+
+            if polls % self.odu_every == 0:
+                await self.request("POST", f"/systems/{self.serial}/odu_status", form_body(odu_status_xml(self)))
+            if polls % self.equipment_every == 0:
+                await self.request("POST", f"/systems/{self.serial}/equipment_events", form_body(equipment_events_xml(self)))
+
+            now = time.perf_counter()
+            await asyncio.sleep(max(0, min(interval - (now - started), deadline - now)))
+
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Local stand-in for an EXPORT_WEBHOOK receiver. Accepts POSTed JSON arrays of samples and counts
+# batches and samples per thermostat. It can be told to answer slowly or fail every Nth batch, to
+# watch the server's export queue and retries without a real analytics backend.
+
+import asyncio
+import json
+from collections import Counter
+
+
+class WebhookReceiver:
+    def __init__(self, delay=0.0, fail_every=0):
+        self.delay = delay
+        self.fail_every = fail_every
+        self.requests = 0
+        self.batches = 0
+        self.samples = Counter()
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=8099):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line[:15].lower() == b"content-length:":
+                        length = int(line[15:])
+                body = await reader.readexactly(length)
+                self.requests += 1
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                if self.fail_every and self.requests % self.fail_every == 0:
+                    status = b"503 Service Unavailable"
+                else:
+                    status = self.receive(body)
+                writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Length: 0\r\n\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def receive(self, body):
+        try:
+            samples = json.loads(body)
+        except ValueError:
+            return b"400 Bad Request"
+        self.batches += 1
+        for sample in samples:
+            self.samples[sample["serial"]] += 1
+        return b"204 No Content"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Standalone webhook receiver for EXPORT_WEBHOOK")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before answering each batch")
+    parser.add_argument("--fail-every", type=int, default=0, help="answer every Nth batch with 503")
+    args = parser.parse_args()
+
+    async def main():
+        receiver = WebhookReceiver(args.delay, args.fail_every)
+        port = await receiver.start(port=args.port)
+        print(f"Listening on {port}")
+        while True:
+            await asyncio.sleep(10)
+            print(f"{receiver.batches} batches, {sum(receiver.samples.values())} samples from {len(receiver.samples)} thermostats")
+
+    asyncio.run(main())
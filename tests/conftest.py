@@ -0,0 +1,12 @@
+import os
+import sys
+
+# The server reads its settings at import time
+os.environ.setdefault("API_SERVER_ADDRESS", "127.0.0.1:8080")
+os.environ.setdefault("MQTT_SERVER", "127.0.0.1")
+os.environ.setdefault("MQTT_PORT", "1883")
+os.environ.setdefault("THERMOSTAT_SERIAL", "TEST0001")
+os.environ.setdefault("THERMOSTAT_NAME", "Test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
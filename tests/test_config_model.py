@@ -0,0 +1,28 @@
+import pytest
+
+import thermostat_api_server as server
+
+
+class TestConfigModel:
+    model = server.ConfigModel({"min_temp": 55, "max_temp": 85, "modes": ["off", "cool", "heat"], "fan_modes": ["auto", "low"]})
+
+    def test_normalises_setpoints_only(self):
+        assert self.model.normalise("clsp", "74.0") == 74
+        assert self.model.normalise("htsp", 68.6) == 68
+        assert self.model.normalise("clsp", "warm") == "warm"
+        assert self.model.normalise("clsp", None) is None
+        assert self.model.normalise("fan", "auto") == "auto"
+
+    def test_validates_setpoint_range(self):
+        assert self.model.validate("clsp", "55") == 55
+        assert self.model.validate("htsp", 85.0) == 85
+        for value in ("54", "86", "warm", "inf", "nan"):
+            with pytest.raises(ValueError):
+                self.model.validate("clsp", value)
+
+    def test_validates_choices(self):
+        assert self.model.validate("mode", "heat") == "heat"
+        assert self.model.validate("hold", "on") == "on"
+        for field, value in (("mode", "auto"), ("fan", "high"), ("hold", "yes"), ("fan", None)):
+            with pytest.raises(ValueError):
+                self.model.validate(field, value)
@@ -0,0 +1,91 @@
+import thermostat_api_server as server
+
+
+def fault(time, code, **fields):
+    return ("equipment_events/event", dict(fields, time=time, code=code), [{}])
+
+
+def test_duplicates_are_ignored():
+    store = server.EventStore(":memory:", 0)
+    store.add("S1", "equipment_events", [fault("T2024-01-01T00:00:00", "E1", id="0"), fault("T2024-01-02T00:00:00", "E2", id="1")])
+    # The thermostat resends its whole history with shifted ids
+    store.add("S1", "equipment_events", [fault("T2024-01-01T00:00:00", "E1", id="1"), fault("T2024-01-02T00:00:00", "E2", id="2")])
+    assert store.rows == 2
+    assert [entry["code"] for entry in store.query("S1")["events"]] == ["E2", "E1"]
+    # Other thermostats and sources are kept apart
+    store.add("S2", "equipment_events", [fault("T2024-01-01T00:00:00", "E1")])
+    store.add("S1", "alerts", [fault("T2024-01-01T00:00:00", "E1")])
+    assert store.rows == 4
+
+
+def test_changed_record_is_updated():
+    store = server.EventStore(":memory:", 0)
+    store.add("S1", "equipment_events", [fault("2024-01-01T00:00:00", "E1", active="on")])
+    store.add("S1", "equipment_events", [fault("2024-01-01T00:00:00", "E1", active="off", description="Cleared")])
+    events = store.query("S1")["events"]
+    assert len(events) == 1
+    assert events[0]["active"] == "off"
+    assert events[0]["description"] == "Cleared"
+    assert events[0]["time"] == "2024-01-01T00:00:00"
+
+
+def test_records_without_time_or_code_are_keyed_by_content():
+    store = server.EventStore(":memory:", 0)
+    records = [("alerts/alert", {"text": "Filter"}, [{}]), ("alerts/alert", {"text": "Battery"}, [{}])]
+    store.add("S1", "alerts", records)
+    store.add("S1", "alerts", [("alerts/alert", {"text": "Filter"}, [{}])])
+    assert sorted(entry["record"]["text"] for entry in store.query("S1")["events"]) == ["Battery", "Filter"]
+
+
+def test_time_is_inherited_from_ancestors():
+    store = server.EventStore(":memory:", 0)
+    store.add("S1", "equipment_events", [("day/event", {"code": "E1"}, [{}, {"date": "2024-01-03"}])])
+    assert store.query("S1")["events"][0]["time"] == "2024-01-03"
+
+
+def test_cursor_pages_through_equal_times():
+    store = server.EventStore(":memory:", 0)
+    store.add("S1", "equipment_events", [fault(f"2024-01-0{1 + index // 4}", f"E{index}") for index in range(10)])
+
+    seen, cursor = [], None
+    while True:
+        page = store.query("S1", limit=3, cursor=cursor)
+        seen.extend(entry["code"] for entry in page["events"])
+        if page["next"] is None:
+            break
+        time, _, row = page["next"].rpartition("|")
+        cursor = (time, int(row))
+    assert sorted(seen) == sorted(f"E{index}" for index in range(10))
+    assert len(seen) == 10
+    times = [store.query("S1", limit=10)["events"][index]["time"] for index in range(10)]
+    assert times == sorted(times, reverse=True)
+
+
+def test_query_filters():
+    store = server.EventStore(":memory:", 0)
+    store.add("S1", "equipment_events", [fault("2024-01-01", "E1"), fault("2024-01-02", "E2"), fault("2024-01-03", "E1")])
+    assert [entry["time"] for entry in store.query("S1", code="E1")["events"]] == ["2024-01-03", "2024-01-01"]
+    assert [entry["time"] for entry in store.query("S1", start="2024-01-02", end="2024-01-03")["events"]] == ["2024-01-02"]
+    assert store.query("S1", source="alerts")["events"] == []
+    assert store.query("S2")["events"] == []
+
+
+def test_oldest_rows_are_pruned():
+    store = server.EventStore(":memory:", 5)
+    store.add("S1", "equipment_events", [fault(f"2024-01-{day:02d}", "E1") for day in range(1, 9)])
+    assert store.rows == 5
+    assert [entry["time"] for entry in store.query("S1")["events"]][-1] == "2024-01-04"
+
+
+def test_parse_message_hands_records_over_in_batches(monkeypatch):
+    monkeypatch.setattr(server, "EVENT_BATCH_SIZE", 3)
+    events = "".join(f"<event><code>E{index}</code><active>on</active></event>" for index in range(7))
+    message = f"<equipment_events><day><date>2024-01-03</date>{events}</day></equipment_events>"
+    batches = []
+
+    server.parse_message([bytes(message[:40], "utf8"), bytes(message[40:], "utf8")], set(), on_records=batches.append)
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    context, fields, inherited = batches[0][0]
+    assert context == "day/event"
+    assert fields == {"code": "E0", "active": "on"}
+    assert server.event_time(fields, inherited) == "2024-01-03"
@@ -0,0 +1,37 @@
+import thermostat_api_server as server
+
+
+def make_ring(capacity, timestamps):
+    ring = server.RingBuffer(capacity, ("value",))
+    for timestamp in timestamps:
+        ring.append(timestamp, float(timestamp))
+    return ring
+
+
+def test_bisect_empty():
+    ring = make_ring(4, [])
+    assert ring.bisect(0) == 0
+    assert ring.bisect(100) == 0
+    assert ring.range(0, 100) == []
+
+
+def test_bisect_before_wrap():
+    ring = make_ring(8, [10, 20, 30])
+    assert [ring.bisect(timestamp) for timestamp in (5, 10, 11, 30, 31)] == [0, 0, 1, 2, 3]
+
+
+def test_bisect_after_wrap():
+    ring = make_ring(4, [10, 20, 30, 40, 50, 60])
+    assert ring.start == 2
+    assert [ring.bisect(timestamp) for timestamp in (5, 30, 35, 60, 61)] == [0, 0, 1, 3, 4]
+    assert ring.range(35, 50) == [(40, 40.0), (50, 50.0)]
+    assert not ring.covers(20)
+    assert ring.covers(30)
+
+
+def test_bisect_equal_timestamps():
+    ring = make_ring(6, [10, 20, 20, 20, 30, 40, 50])
+    assert ring.times[ring.start] == 20
+    assert ring.bisect(20) == 0
+    assert ring.bisect(21) == 3
+    assert [row[0] for row in ring.range(20, 30)] == [20, 20, 20, 30]
@@ -0,0 +1,204 @@
+import itertools
+import threading
+
+import thermostat_api_server as server
+
+serials = itertools.count(1)
+
+REPORTED = {"mode": "cool", "fan": "auto", "hold": "off", "htsp": "68.0", "clsp": "74.0"}
+
+
+def make_thermostat(reported=None):
+    thermostat = server.Thermostat(f"PENDING{next(serials):04d}", "Pending")
+    if reported is not None:
+        thermostat.current_configuration.update(reported)
+        thermostat.commands.reported(thermostat.current_configuration)
+    return thermostat
+
+
+def report(thermostat, **changes):
+    thermostat.current_configuration.update(changes)
+    thermostat.commands.reported(thermostat.current_configuration)
+
+
+def test_submit_marks_field_pending():
+    thermostat = make_thermostat(REPORTED)
+    version = thermostat.commands.submit("temperature", "72")
+    assert version == 1
+    assert thermostat.commands.fields == {"clsp": 1}
+    assert thermostat.candidate_configuration["clsp"] == 72
+    assert thermostat.changes_pending
+    assert thermostat.current_configuration["changes_pending"] == "ON"
+
+
+def test_submit_ignores_unchanged_invalid_and_unknown():
+    thermostat = make_thermostat(REPORTED)
+    assert thermostat.commands.submit("temperature", "74") == 0
+    assert thermostat.commands.submit("fan_mode", "auto") == 0
+    assert thermostat.commands.submit("temperature", "99") == 0
+    assert thermostat.commands.submit("swing_mode", "on") == 0
+    assert thermostat.commands.version == 0
+    assert not thermostat.changes_pending
+
+
+def test_temperature_follows_mode():
+    thermostat = make_thermostat(dict(REPORTED, mode="heat"))
+    thermostat.commands.submit("temperature", "70")
+    assert thermostat.commands.fields == {"htsp": 1}
+
+    thermostat = make_thermostat(dict(REPORTED, mode="off"))
+    assert thermostat.commands.submit("temperature", "70") == 0
+    assert make_thermostat().commands.submit("temperature", "70") == 0
+
+
+def test_burst_is_coalesced_into_one_delivery():
+    thermostat = make_thermostat(REPORTED)
+    for setpoint in ("73", "72", "71"):
+        thermostat.commands.submit("temperature", setpoint)
+    thermostat.commands.submit("fan_mode", "low")
+    assert thermostat.commands.fields == {"clsp": 3, "fan": 4}
+
+    configuration, version = thermostat.commands.take()
+    assert version == 4
+    assert configuration["clsp"] == 71 and configuration["fan"] == "low"
+    assert thermostat.commands.awaiting[0] == {"clsp": 71, "fan": "low"}
+    assert not thermostat.commands.fields
+    assert not thermostat.changes_pending
+    assert thermostat.commands.submitted is None
+
+
+def test_returning_to_baseline_cancels_pending_field():
+    thermostat = make_thermostat(REPORTED)
+    thermostat.commands.submit("temperature", "72")
+    thermostat.commands.submit("hold", "on")
+    thermostat.commands.submit("temperature", "74")
+    assert thermostat.commands.fields == {"hold": 2}
+    thermostat.commands.submit("hold", "off")
+    assert not thermostat.commands.fields
+    assert not thermostat.changes_pending
+    assert thermostat.commands.submitted is None
+
+
+def test_baseline_is_the_delivered_value_until_applied():
+    thermostat = make_thermostat(REPORTED)
+    thermostat.commands.submit("temperature", "72")
+    thermostat.commands.take()
+    # Going back to 74 now has to be sent, the thermostat is about to switch to 72
+    assert thermostat.commands.submit("temperature", "74") == 2
+    assert thermostat.commands.fields == {"clsp": 2}
+
+
+def test_take_waits_for_every_setting():
+    thermostat = make_thermostat({"mode": "cool", "fan": "auto"})
+    thermostat.commands.submit("fan_mode", "low")
+    configuration, version = thermostat.commands.take()
+    assert configuration is None and version == 1
+    assert thermostat.changes_pending
+
+    report(thermostat, hold="off", htsp="68", clsp="74")
+    configuration, version = thermostat.commands.take()
+    assert configuration == {"mode": "cool", "fan": "low", "hold": "off", "htsp": 68, "clsp": 74}
+    assert version == 1
+
+
+def test_reported_applies_delivered_change():
+    thermostat = make_thermostat(REPORTED)
+    thermostat.commands.submit("temperature", "72")
+    thermostat.commands.take()
+
+    # A status post from before the thermostat fetched /config doesn't undo the change
+    report(thermostat)
+    assert thermostat.candidate_configuration["clsp"] == 72
+    assert thermostat.commands.awaiting is not None
+
+    report(thermostat, clsp="72.0")
+    assert thermostat.commands.awaiting is None
+    assert thermostat.candidate_configuration["clsp"] == 72
+
+
+def test_reported_gives_up_after_apply_polls():
+    thermostat = make_thermostat(REPORTED)
+    thermostat.commands.submit("temperature", "72")
+    thermostat.commands.take()
+    for _ in range(server.CONFIG_APPLY_POLLS - 1):
+        report(thermostat)
+        assert thermostat.candidate_configuration["clsp"] == 72
+    report(thermostat)
+    assert thermostat.commands.awaiting is None
+    # The thermostat's own value is trusted again
+    assert thermostat.candidate_configuration["clsp"] == 74
+
+
+def test_reported_adopts_changes_made_at_the_thermostat():
+    thermostat = make_thermostat(REPORTED)
+    thermostat.commands.submit("fan_mode", "low")
+    report(thermostat, clsp="76", fan="high")
+    assert thermostat.candidate_configuration["clsp"] == 76
+    # A pending command wins over what the thermostat reports
+    assert thermostat.candidate_configuration["fan"] == "low"
+    assert thermostat.commands.fields == {"fan": 1}
+
+
+def test_reported_drops_pending_field_already_applied():
+    thermostat = make_thermostat(REPORTED)
+    thermostat.commands.submit("fan_mode", "low")
+    report(thermostat, fan="low")
+    assert not thermostat.commands.fields
+    assert not thermostat.changes_pending
+    assert thermostat.current_configuration["changes_pending"] == "OFF"
+
+
+def test_restore_resumes_pending_fields():
+    thermostat = make_thermostat(REPORTED)
+    thermostat.commands.submit("temperature", "70")
+    snapshot = thermostat.snapshot()
+    assert snapshot["pending_fields"] == ["clsp"]
+
+    restored = make_thermostat()
+    restored.restore(snapshot)
+    assert restored.commands.fields == {"clsp": 0}
+    assert restored.candidate_configuration["clsp"] == 70
+    assert restored.commands.submitted is not None
+    assert restored.changes_pending
+
+    configuration, _ = restored.commands.take()
+    assert configuration["clsp"] == 70
+    assert restored.commands.awaiting[0] == {"clsp": 70}
+    report(restored, clsp="70")
+    assert restored.commands.awaiting is None
+
+
+def test_restore_without_pending_fields():
+    restored = make_thermostat()
+    restored.restore(make_thermostat(REPORTED).snapshot())
+    assert not restored.commands.fields
+    assert restored.commands.submitted is None
+    assert not restored.changes_pending
+    # Setpoints from the snapshot are compared as numbers again
+    assert restored.commands.submit("temperature", "74") == 0
+
+
+def test_concurrent_submit_and_take_deliver_the_last_command():
+    thermostat = make_thermostat(REPORTED)
+    setpoints = [str(55 + index % 30) for index in range(2000)]
+    taken = []
+
+    def submit():
+        for setpoint in setpoints:
+            thermostat.commands.submit("temperature", setpoint)
+
+    def take():
+        for _ in range(500):
+            taken.append(thermostat.commands.take()[1])
+
+    threads = [threading.Thread(target=submit), threading.Thread(target=take)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert taken == sorted(taken)
+    configuration, version = thermostat.commands.take()
+    assert version == thermostat.commands.version
+    assert configuration["clsp"] == int(setpoints[-1])
+    assert not thermostat.commands.fields
@@ -4,8 +4,26 @@ from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse
 from socketserver import ThreadingMixIn
 from urllib.parse import parse_qs
-from urllib.parse import unquote
+from urllib.parse import unquote_to_bytes
+from email.utils import formatdate
 import xml.etree.ElementTree as ET
+import asyncio
+import threading
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing.managers import BaseManager
+import socket
+import hashlib
+import sqlite3
+from array import array
+from collections import OrderedDict, deque
+import csv
+import io
+import math
+import urllib.request
+import urllib.error
+import signal
+import sys
 import paho.mqtt.client as mqttClient
 import datetime
 import os
@@ -22,455 +40,2189 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Startup is measured from process start, interpreter and imports included, to the HTTP listener
+# being bound. Past the budget a restart is long enough for a thermostat poll to fail.
+STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET', '1.0'))
+module_started = time.monotonic()
+
+def process_uptime():
+    try:
+        with open("/proc/self/stat") as stat:
+            started = int(stat.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started
+    except (OSError, ValueError, AttributeError):
+        return time.monotonic() - module_started
 
 # Allow faster script restart
 socketserver.TCPServer.allow_reuse_address = True
 
-candidate_configuration = {"hold": "on", "fan": "auto"}
-current_configuration = {"changes_pending": "OFF"}
-changes_pending = False
-first_start = True
-
 api_server_address = os.environ['API_SERVER_ADDRESS']
 mqtt_address = os.environ['MQTT_SERVER']
 mqtt_port = int(os.environ['MQTT_PORT'])
 if 'MQTT_USERNAME' in os.environ:
   mqtt_username = os.environ['MQTT_USERNAME']
   mqtt_password = os.environ['MQTT_PASSWORD']
-thermostat_name = os.environ['THERMOSTAT_NAME']
-thermostat_command_topic = f"homeassistant/climate/{thermostat_name}/cmnd"
-thermostat_state_topic = f"homeassistant/climate/{thermostat_name}/state"
-thermostat_serial = os.environ['THERMOSTAT_SERIAL']
-
-device = {"mdl": "TSTAT0201CW", "sw": "Unknown", "mf": "Observer", "ids": thermostat_serial, "name": thermostat_name}
-
-climate_configuration_payload = {
-    "act_t": thermostat_state_topic,
-    "act_tpl": "{% if value_json.coolicon == 'on' %}cooling{% elif value_json.heaticon == 'on' %}heating{% elif value_json.coolicon == 'off' and value_json.heaticon == 'off' %}idle{% endif %}",
-    "curr_temp_t": thermostat_state_topic,
-    "curr_temp_tpl": "{{ value_json.rt }}",
-    "device": device,
-    "fan_modes": ["auto","low","med","high"],
-    "fan_mode_cmd_t": thermostat_command_topic + "/fan_mode",
-    "fan_mode_stat_t": thermostat_state_topic,
-    "fan_mode_stat_tpl": "{{ value_json.fan }}",
-    "max_temp": 85,
-    "min_temp": 55,
-    "mode_cmd_t": thermostat_command_topic + "/operating_mode",
-    "mode_stat_t": thermostat_state_topic,
-    "mode_stat_tpl": "{{ value_json.mode }}",
-    "modes": ["off", "cool", "heat"],
-    "name": thermostat_name,
-    "temp_cmd_t": thermostat_command_topic + "/temperature",
-    "temp_stat_t": thermostat_state_topic,
-    "temp_stat_tpl": "{% if value_json.mode == 'cool' %}{{ value_json.clsp }}{% elif value_json.mode == 'heat' %}{{ value_json.htsp }}{% endif %}",
-    "temp_step":"1",
-    "temperature_unit": "F",
-    "uniq_id": thermostat_serial
-}
+
+# The settings /config delivers, in the order the reply template takes them, and the setting each
+# Home Assistant command changes. Temperature goes to the setpoint of the mode the thermostat will be in.
+CONFIG_FIELDS = ("mode", "fan", "hold", "htsp", "clsp")
+COMMAND_FIELDS = {"operating_mode": "mode", "fan_mode": "fan", "hold": "hold"}
+SETPOINT_FIELDS = {"cool": "clsp", "heat": "htsp"}
+
+# Status posts to wait for a delivered configuration to show up before trusting what the thermostat reports again
+CONFIG_APPLY_POLLS = 3
+
+# Typed view of the /config settings. Setpoints are whole degrees, so "74", "74.0" and 74 compare
+# equal, and commands are checked against the limits the climate entity advertises to Home Assistant.
+class ConfigModel:
+    def __init__(self, climate_configuration):
+        self.min_temp = climate_configuration["min_temp"]
+        self.max_temp = climate_configuration["max_temp"]
+        self.choices = {"mode": climate_configuration["modes"], "fan": climate_configuration["fan_modes"], "hold": ["on", "off"]}
+
+    # Values the thermostat reports are taken as they come, only setpoints are converted
+    def normalise(self, field, value):
+        if value is not None and field in ("htsp", "clsp"):
+            try:
+                return int(float(value))
+            except (ValueError, OverflowError):
+                return value
+        return value
+
+    # Raises ValueError for anything the thermostat shouldn't be sent
+    def validate(self, field, value):
+        value = self.normalise(field, value)
+        if field in ("htsp", "clsp"):
+            if not isinstance(value, int) or not self.min_temp <= value <= self.max_temp:
+                raise ValueError(f"{field} {value} is not between {self.min_temp} and {self.max_temp}")
+        elif value not in self.choices[field]:
+            raise ValueError(f"{field} {value} is not one of {', '.join(self.choices[field])}")
+        return value
+
+# Commands from Home Assistant wait here until the thermostat fetches /config. Paho's network thread
+# submits and the HTTP handlers take, always under the lock, so a command that lands while /config
+# is being served is either in that reply or still pending for the next one. Reading
+# changes_pending on the /status path needs no lock.
+#
+# candidate_configuration is what the thermostat should end up with: what it last reported, or was
+# last sent and hasn't reported yet, overlaid with the pending fields. A command that matches it
+# changes nothing, and one that returns a field to what the thermostat already has cancels that
+# field, so a thermostat is only asked to fetch /config when the result would differ.
+class PendingChanges:
+    def __init__(self, thermostat):
+        self.thermostat = thermostat
+        self.lock = threading.Lock()
+        self.version = 0
+        self.delivered_version = 0
+        # Field -> version of the command that last changed it
+        self.fields = {}
+        # Monotonic times of the last command and of the oldest one not yet delivered
+        self.last_command = None
+        self.submitted = None
+        # (fields, submitted) delivered by /config and not yet seen in a status post
+        self.awaiting = None
+        self.awaiting_polls = 0
+
+    # What the thermostat has, or will have once it applies the configuration it last fetched
+    def baseline(self, field):
+        if self.awaiting is not None and field in self.awaiting[0]:
+            return self.awaiting[0][field]
+        return self.thermostat.config_model.normalise(field, self.thermostat.current_configuration.get(field))
+
+    def settle(self):
+        thermostat = self.thermostat
+        if not self.fields:
+            self.submitted = None
+        thermostat.changes_pending = bool(self.fields)
+        thermostat.current_configuration["changes_pending"] = "ON" if self.fields else "OFF"
+
+    def submit(self, command, payload):
+        thermostat = self.thermostat
+        candidate_configuration = thermostat.candidate_configuration
+        with self.lock:
+            if command == "temperature":
+                field = SETPOINT_FIELDS.get(candidate_configuration.get("mode"))
+            else:
+                field = COMMAND_FIELDS.get(command)
+            if field is None:
+                return 0
+            try:
+                value = thermostat.config_model.validate(field, payload)
+            except ValueError as error:
+                logging.warning(f"Ignoring {command} command for {thermostat.name}: {error}")
+                metrics.inc("thermostat_commands_ignored_total", (("reason", "invalid"),))
+                return 0
+            if value == candidate_configuration.get(field):
+                metrics.inc("thermostat_commands_ignored_total", (("reason", "unchanged"),))
+                return 0
+
+            # Later commands for the same field replace earlier ones, so a burst goes out as one config
+            self.last_command = time.monotonic()
+            self.version += 1
+            if field in self.fields:
+                metrics.inc("thermostat_commands_coalesced_total")
+            if value == self.baseline(field):
+                self.fields.pop(field, None)
+            else:
+                if self.submitted is None:
+                    self.submitted = self.last_command
+                self.fields[field] = self.version
+            candidate_configuration[field] = value
+            self.settle()
+            return self.version
+
+    # Everything submitted before this point is delivered with the returned configuration, which is
+    # None until the thermostat has reported every setting at least once
+    def take(self):
+        thermostat = self.thermostat
+        with self.lock:
+            configuration = dict(thermostat.candidate_configuration)
+            if any(configuration.get(field) is None for field in CONFIG_FIELDS):
+                return None, self.version
+            self.delivered_version = self.version
+            if self.submitted is not None:
+                metrics.observe("thermostat_command_delivery_seconds", (), time.monotonic() - self.submitted)
+                self.awaiting = ({field: configuration[field] for field in self.fields}, self.submitted)
+                self.awaiting_polls = 0
+            self.fields.clear()
+            self.settle()
+            return configuration, self.delivered_version
+
+    # Called for every status post. The delivered change counts as applied once the thermostat
+    # reports it, and settings changed at the thermostat itself are adopted unless a command for
+    # them is pending.
+    def reported(self, current_configuration):
+        thermostat = self.thermostat
+        model = thermostat.config_model
+        candidate_configuration = thermostat.candidate_configuration
+        applied = None
+        with self.lock:
+            if self.awaiting is not None:
+                fields, submitted = self.awaiting
+                if all(model.normalise(field, current_configuration.get(field)) == value for field, value in fields.items()):
+                    self.awaiting = None
+                    applied = submitted
+                else:
+                    self.awaiting_polls += 1
+                    if self.awaiting_polls >= CONFIG_APPLY_POLLS:
+                        logging.warning(f"{thermostat.name} has not applied {fields} after {self.awaiting_polls} status posts")
+                        self.awaiting = None
+
+            for field in CONFIG_FIELDS:
+                if self.awaiting is not None and field in self.awaiting[0]:
+                    continue
+                value = model.normalise(field, current_configuration.get(field))
+                if value is None:
+                    continue
+                if field in self.fields:
+                    # Already set at the thermostat, nothing left to send
+                    if value == candidate_configuration.get(field):
+                        del self.fields[field]
+                else:
+                    candidate_configuration[field] = value
+            if thermostat.changes_pending and not self.fields:
+                self.settle()
+
+        if applied is not None:
+            latency = time.monotonic() - applied
+            metrics.observe("thermostat_command_apply_seconds", (), latency)
+            logging.info(f"Change for {thermostat.name} applied {latency:.1f}s after the command")
+
+    def restore(self, fields):
+        model = self.thermostat.config_model
+        candidate_configuration = self.thermostat.candidate_configuration
+        with self.lock:
+            for field in CONFIG_FIELDS:
+                if field in candidate_configuration:
+                    candidate_configuration[field] = model.normalise(field, candidate_configuration[field])
+            self.fields = {field: 0 for field in fields if field in CONFIG_FIELDS}
+            # The original command time is gone, latencies for restored changes count from the restart
+            if self.fields:
+                self.submitted = time.monotonic()
+
+class Thermostat:
+    def __init__(self, serial, name):
+        self.serial = serial
+        self.name = name
+        self.command_topic = f"homeassistant/climate/{name}/cmnd"
+        self.state_topic = f"homeassistant/climate/{name}/state"
+
+        self.candidate_configuration = {}
+        self.current_configuration = {"changes_pending": "OFF"}
+        self.changes_pending = False
+        self.first_start = True
+        self.persisted_snapshot = None
+        self.last_seen = None
+
+        self.device = {"mdl": "TSTAT0201CW", "sw": "Unknown", "mf": "Observer", "ids": serial, "name": name}
+        # Firmware and IP only ride along with the climate entity, so learning them doesn't touch the sensors
+        self.entity_device = {"mdl": "TSTAT0201CW", "mf": "Observer", "ids": serial, "name": name}
+        self.climate_topic = f'homeassistant/climate/{serial}-climate/config'
+
+        self.climate_configuration_payload = {
+            "act_t": self.state_topic,
+            "act_tpl": "{% if value_json.coolicon == 'on' %}cooling{% elif value_json.heaticon == 'on' %}heating{% elif value_json.coolicon == 'off' and value_json.heaticon == 'off' %}idle{% endif %}",
+            "curr_temp_t": self.state_topic,
+            "curr_temp_tpl": "{{ value_json.rt }}",
+            "device": self.device,
+            "fan_modes": ["auto","low","med","high"],
+            "fan_mode_cmd_t": self.command_topic + "/fan_mode",
+            "fan_mode_stat_t": self.state_topic,
+            "fan_mode_stat_tpl": "{{ value_json.fan }}",
+            "max_temp": 85,
+            "min_temp": 55,
+            "mode_cmd_t": self.command_topic + "/operating_mode",
+            "mode_stat_t": self.state_topic,
+            "mode_stat_tpl": "{{ value_json.mode }}",
+            "modes": ["off", "cool", "heat"],
+            "name": name,
+            "temp_cmd_t": self.command_topic + "/temperature",
+            "temp_stat_t": self.state_topic,
+            "temp_stat_tpl": "{% if value_json.mode == 'cool' %}{{ value_json.clsp }}{% elif value_json.mode == 'heat' %}{{ value_json.htsp }}{% endif %}",
+            "temp_step":"1",
+            "temperature_unit": "F",
+            "uniq_id": serial
+        }
+        self.config_model = ConfigModel(self.climate_configuration_payload)
+        self.commands = PendingChanges(self)
+
+    def publish_state(self):
+        state_publisher.publish(self)
+
+    def state_payload(self):
+        # Unknown values have always been published as "" rather than null
+        state = dict(self.current_configuration)
+        return json.dumps({key: "" if value is None else value for key, value in state.items()})
+
+    def publish_climate_configuration(self):
+        discovery.update({self.climate_topic: json.dumps(self.climate_configuration_payload)})
+        self.persist()
+
+    def discovery_payloads(self):
+        payloads = {self.climate_topic: json.dumps(self.climate_configuration_payload)}
+        for component, object_id, entity in DISCOVERY_ENTITIES:
+            payload = {"device": self.entity_device, "stat_t": self.state_topic}
+            for key, value in entity.items():
+                if key == "name":
+                    value = f"{self.name} {value}"
+                elif key == "uniq_id":
+                    value = f"{self.serial}-{value}"
+                payload[key] = value
+            payloads[f'homeassistant/{component}/{self.serial}-{object_id}/config'] = json.dumps(payload)
+        return payloads
+
+    def snapshot(self):
+        with self.commands.lock:
+            return {
+                "current_configuration": dict(self.current_configuration),
+                "candidate_configuration": dict(self.candidate_configuration),
+                "changes_pending": self.changes_pending,
+                "pending_fields": sorted(self.commands.fields),
+                "device": {key: self.device[key] for key in ("sw", "cns") if key in self.device},
+            }
+
+    def restore(self, snapshot):
+        self.current_configuration.update(snapshot["current_configuration"])
+        self.candidate_configuration.update(snapshot["candidate_configuration"])
+        self.changes_pending = snapshot["changes_pending"]
+        # Older snapshots only say that something was pending, so keep all of it
+        self.commands.restore(snapshot.get("pending_fields", self.candidate_configuration) if self.changes_pending else ())
+        self.device.update(snapshot["device"])
+
+    # Identical snapshots are not written twice
+    def persist(self):
+        snapshot = json.dumps(self.snapshot())
+        if snapshot != self.persisted_snapshot:
+            state_store.save(self.serial, snapshot)
+            self.persisted_snapshot = snapshot
+
+    # Take firmware and IP from our retained climate config until the thermostat reports them itself
+    def adopt_device(self, device):
+        adopted = False
+        if self.device["sw"] == "Unknown" and device.get("sw", "Unknown") != "Unknown":
+            self.device["sw"] = device["sw"]
+            adopted = True
+        if "cns" not in self.device and "cns" in device:
+            self.device["cns"] = device["cns"]
+            adopted = True
+        return adopted
+
+# Counters and histograms for /metrics in the Prometheus text format. Updating one is a dict
+# operation under a lock, cheap enough for every request where a log line is not.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Commands wait on the thermostat's poll, so their latency is seconds to minutes
+COMMAND_LATENCY_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+        self.buckets = {}
+
+    def describe(self, name, kind, text, buckets=LATENCY_BUCKETS):
+        self.help[name] = (kind, text)
+        self.buckets[name] = buckets
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self.lock:
+            buckets = self.buckets.get(name, LATENCY_BUCKETS)
+            if key not in self.histograms:
+                self.histograms[key] = [0] * len(buckets) + [0.0, 0]
+            histogram = self.histograms[key]
+            for index, bound in enumerate(buckets):
+                if seconds <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def render(self):
+        with self.lock:
+            samples = {}
+            for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()):
+                samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(self.buckets.get(name, LATENCY_BUCKETS), histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram[-1]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram[-2]}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram[-1]}")
+        output = []
+        for name in sorted(samples):
+            if name in self.help:
+                kind, text = self.help[name]
+                output.append(f"# HELP {name} {text}")
+                output.append(f"# TYPE {name} {kind}")
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+def escape_label(value):
+    return f"{value}".replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+metrics.describe("thermostat_http_requests_total", "counter", "HTTP requests by method and path")
+metrics.describe("thermostat_http_request_duration_seconds", "histogram", "Time spent handling HTTP requests by path")
+metrics.describe("thermostat_http_received_bytes_total", "counter", "HTTP request body bytes received")
+metrics.describe("thermostat_http_sent_bytes_total", "counter", "HTTP response bytes sent")
+metrics.describe("thermostat_xml_parse_duration_seconds", "histogram", "Time spent parsing thermostat XML by path")
+metrics.describe("thermostat_mqtt_publishes_total", "counter", "MQTT publishes by kind and result")
+metrics.describe("thermostat_mqtt_publishes_written_total", "counter", "MQTT publishes written to the socket by paho")
+metrics.describe("thermostat_mqtt_publish_queue_depth", "gauge", "MQTT publishes handed to paho but not yet written to the socket")
+metrics.describe("thermostat_mqtt_outbound_queued", "gauge", "Topics waiting in the outbound queue in memory")
+metrics.describe("thermostat_mqtt_outbound_spooled", "gauge", "Topics waiting in the outbound queue on disk")
+metrics.describe("thermostat_mqtt_outbound_coalesced_total", "counter", "Queued publishes replaced by a newer payload for the same topic")
+metrics.describe("thermostat_mqtt_outbound_dropped_total", "counter", "Queued publishes dropped because the queue was full and no spool is configured")
+metrics.describe("thermostat_startup_seconds", "gauge", "Seconds from process start to the HTTP listener being bound")
+metrics.describe("thermostat_mqtt_outbound_replayed_total", "counter", "Queued publishes sent after the broker came back or caught up")
+metrics.describe("thermostat_events_stored_total", "counter", "Uploaded equipment events, faults and history entries by source and whether they were new, changed or already stored")
+metrics.describe("thermostat_events_rows", "gauge", "Entries held in the event store")
+metrics.describe("thermostat_export_samples_total", "counter", "Samples handled by export sinks by sink and result")
+metrics.describe("thermostat_export_queued", "gauge", "Samples waiting in each export sink's queue")
+metrics.describe("thermostat_state_publish_pending", "gauge", "Thermostats waiting for a coalesced state publish")
+metrics.describe("thermostat_last_seen_seconds", "gauge", "Seconds since the thermostat last posted anything")
+metrics.describe("thermostat_changes_pending", "gauge", "1 while a configuration change waits for the thermostat")
+metrics.describe("thermostat_mqtt_commands_total", "counter", "Commands received from Home Assistant by command")
+metrics.describe("thermostat_commands_ignored_total", "counter", "Commands that would not change the configuration or were out of range, by reason")
+metrics.describe("thermostat_commands_coalesced_total", "counter", "Pending changes replaced by a newer command before the thermostat fetched them")
+metrics.describe("thermostat_command_delivery_seconds", "histogram", "Time from the first pending command to the thermostat fetching /config", COMMAND_LATENCY_BUCKETS)
+metrics.describe("thermostat_command_apply_seconds", "histogram", "Time from the first pending command to the thermostat reporting it applied", COMMAND_LATENCY_BUCKETS)
+metrics.describe("thermostat_ping_rate_seconds", "gauge", "pingRate currently advertised to the thermostat, 0 leaves polling to the thermostat")
+
+# Fixed set of path labels so odd requests can't blow up the number of series
+METRIC_PATHS = {"status", "odu_status", "equipment_events", "profile", "config", "time", "Alive", "idu_faults", "odu_faults", "history", "metrics"}
+
+def path_label(path):
+    if path.startswith("/api/"):
+        return "api"
+    resource = urlparse(path).path.rstrip("/").split("/")[-1]
+    return f"/{resource}" if resource in METRIC_PATHS else "other"
+
+# True once the publish is sent or queued for later
+def mqtt_publish(topic, payload, kind):
+    return outbound.publish(topic, payload, kind)
+
+def on_publish(client, userdata, mid, reason_code, properties):
+    outbound.written += 1
+    metrics.inc("thermostat_mqtt_publishes_written_total")
+
+# Optional persistence so a restart resumes with the last known state and any queued changes.
+# STATE_STORE=sqlite:/path/to/state.db or log:/path/to/state.log, unset keeps state in memory only.
+class StateStore:
+    def load(self):
+        return {}
+
+    def save(self, serial, snapshot):
+        pass
+
+class SqliteStateStore(StateStore):
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS thermostat_state (serial TEXT PRIMARY KEY, snapshot TEXT NOT NULL, updated REAL NOT NULL)")
+
+    def load(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT serial, snapshot FROM thermostat_state").fetchall()
+        return {serial: json.loads(snapshot) for serial, snapshot in rows}
+
+    def save(self, serial, snapshot):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO thermostat_state VALUES (?, ?, ?)", (serial, snapshot, time.time()))
+
+# One JSON line per snapshot, last line per serial wins. The log is rewritten with only the
+# latest snapshots at startup and whenever it grows past max_lines.
+class LogStateStore(StateStore):
+    def __init__(self, path, max_lines=10000):
+        self.lock = threading.Lock()
+        self.path = path
+        self.max_lines = max_lines
+        self.snapshots = {}
+        if os.path.exists(path):
+            with open(path) as log:
+                for line in log:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn final write
+                        continue
+                    self.snapshots[entry["serial"]] = entry["snapshot"]
+        self.compact()
+
+    def compact(self):
+        with open(f"{self.path}.tmp", "w") as log:
+            for serial, snapshot in self.snapshots.items():
+                log.write(json.dumps({"serial": serial, "snapshot": snapshot}) + "\n")
+        os.replace(f"{self.path}.tmp", self.path)
+        self.log = open(self.path, "a")
+        self.lines = len(self.snapshots)
+
+    def load(self):
+        return {serial: json.loads(snapshot) for serial, snapshot in self.snapshots.items()}
+
+    def save(self, serial, snapshot):
+        with self.lock:
+            self.snapshots[serial] = snapshot
+            self.log.write(json.dumps({"serial": serial, "snapshot": snapshot}) + "\n")
+            self.log.flush()
+            self.lines += 1
+            if self.lines > self.max_lines:
+                self.log.close()
+                self.compact()
+
+def open_state_store(url):
+    if not url:
+        return StateStore()
+    kind, _, path = url.partition(":")
+    if kind == "sqlite":
+        return SqliteStateStore(path)
+    if kind == "log":
+        return LogStateStore(path)
+    raise ValueError(f"Unknown STATE_STORE {url}")
+
+state_store = open_state_store(os.environ.get('STATE_STORE'))
+
+# Deferred MQTT work runs on timer threads, or on the event loop with SERVER_MODE=asyncio
+def report_listening():
+    uptime = process_uptime()
+    metrics.set("thermostat_startup_seconds", value=round(uptime, 3))
+    if uptime > STARTUP_BUDGET:
+        logging.warning(f"Listening on port 8080 {uptime * 1000:.0f} ms after start, over the {STARTUP_BUDGET * 1000:.0f} ms budget")
+    else:
+        logging.info(f"Listening on port 8080 {uptime * 1000:.0f} ms after start")
+
+def call_later(delay, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+
+# State publishes are coalesced: a burst of POSTs within STATE_PUBLISH_DELAY seconds (e.g. status,
+# odu_status and equipment_events back to back) results in a single publish per thermostat, and a
+# payload identical to the one already retained on the broker is not sent again.
+class StatePublisher:
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.digests = {}
+
+    def publish(self, thermostat):
+        if self.delay <= 0:
+            self.send(thermostat)
+            return
+        with self.lock:
+            schedule = not self.pending
+            self.pending[thermostat.serial] = thermostat
+        if schedule:
+            call_later(self.delay, self.flush)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for thermostat in pending.values():
+            self.send(thermostat)
+
+    def send(self, thermostat):
+        thermostat.persist()
+        payload = thermostat.state_payload()
+        digest = hashlib.sha1(bytes(payload, "utf8")).digest()
+        if self.digests.get(thermostat.state_topic) == digest:
+            logging.debug(f"State unchanged for {thermostat.name}, not publishing")
+            metrics.inc("thermostat_mqtt_publishes_total", (("kind", "state"), ("result", "unchanged")))
+            return
+        if mqtt_publish(thermostat.state_topic, payload, "state"):
+            self.digests[thermostat.state_topic] = digest
+
+    # At shutdown only the state store is written, the next run publishes fresh state anyway
+    def persist_pending(self):
+        with self.lock:
+            pending = list(self.pending.values())
+        for thermostat in pending:
+            thermostat.persist()
+
+    # The broker may have lost its retained messages while we were away
+    def forget(self):
+        self.digests.clear()
+
+    # As the MQTT sink every post ends in a state publish, whatever the sample holds
+    def emit(self, thermostat, source, sample):
+        self.publish(thermostat)
+
+# Publishes go straight to paho while connected and keeping up. During an outage, or while paho has
+# more than MQTT_INFLIGHT publishes it hasn't written yet, they wait here instead. Only the newest
+# payload per topic is kept, so memory depends on the number of topics, not on how long the outage
+# lasts. Past MQTT_QUEUE_SIZE topics the oldest spill to MQTT_SPOOL (sqlite) when it is set, and
+# are dropped otherwise. Once connected again the queue is replayed at MQTT_REPLAY_RATE per second.
+OUTBOUND_REPLAY_TICK = 0.1
+
+class OutboundQueue:
+    def __init__(self, size, inflight, replay_rate, spool_path=None):
+        self.lock = threading.Lock()
+        self.size = size
+        self.inflight = inflight
+        self.replay_batch = max(1, int(replay_rate * OUTBOUND_REPLAY_TICK))
+        self.queued = OrderedDict()
+        self.spooled = 0
+        self.connected = False
+        self.draining = False
+        self.sent = 0
+        self.written = 0
+
+        self.spool = None
+        if spool_path:
+            self.spool = sqlite3.connect(spool_path, check_same_thread=False)
+            self.spool.execute("CREATE TABLE IF NOT EXISTS outbound (seq INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT UNIQUE, payload TEXT, kind TEXT)")
+            # Whatever is left from a previous run is stale, fresh state gets published anyway
+            self.spool.execute("DELETE FROM outbound")
+            self.spool.commit()
+
+    def unwritten(self):
+        return self.sent - self.written
+
+    def publish(self, topic, payload, kind):
+        with self.lock:
+            if not self.connected or self.queued or self.spooled or self.unwritten() >= self.inflight:
+                self.enqueue(topic, payload, kind)
+                return True
+        return self.send(topic, payload, kind)
+
+    def send(self, topic, payload, kind):
+        info = client.publish(topic, payload, retain=True)
+        if info.rc == mqttClient.MQTT_ERR_SUCCESS:
+            with self.lock:
+                self.sent += 1
+            metrics.inc("thermostat_mqtt_publishes_total", (("kind", kind), ("result", "sent")))
+            return True
+        if info.rc == mqttClient.MQTT_ERR_NO_CONN:
+            with self.lock:
+                self.connected = False
+                self.enqueue(topic, payload, kind)
+            return True
+        metrics.inc("thermostat_mqtt_publishes_total", (("kind", kind), ("result", "failed")))
+        return False
+
+    # Called with the lock held. Memory holds the newest topics, the spool the oldest.
+    def enqueue(self, topic, payload, kind):
+        metrics.inc("thermostat_mqtt_publishes_total", (("kind", kind), ("result", "queued")))
+        if topic in self.queued:
+            metrics.inc("thermostat_mqtt_outbound_coalesced_total")
+        elif self.spooled and self.spool.execute("DELETE FROM outbound WHERE topic = ?", (topic,)).rowcount:
+            self.spooled -= 1
+            metrics.inc("thermostat_mqtt_outbound_coalesced_total")
+        self.queued[topic] = (payload, kind)
+
+        if len(self.queued) > self.size:
+            old_topic, (old_payload, old_kind) = self.queued.popitem(last=False)
+            if self.spool is None:
+                metrics.inc("thermostat_mqtt_outbound_dropped_total")
+            else:
+                self.spool.execute("INSERT INTO outbound (topic, payload, kind) VALUES (?, ?, ?)", (old_topic, old_payload, old_kind))
+                self.spooled += 1
+        if self.spool is not None:
+            self.spool.commit()
+        self.schedule_drain()
+
+    # Called with the lock held
+    def schedule_drain(self):
+        if self.connected and not self.draining:
+            self.draining = True
+            call_later(OUTBOUND_REPLAY_TICK, self.drain)
+
+    def on_connect(self):
+        with self.lock:
+            self.connected = True
+            # Anything paho hadn't written went down with the old connection
+            self.sent = self.written
+            if self.queued or self.spooled:
+                logging.info(f"Replaying {len(self.queued) + self.spooled} queued MQTT publishes")
+                self.schedule_drain()
+
+    def on_disconnect(self):
+        with self.lock:
+            self.connected = False
+
+    def drain(self):
+        batch = []
+        with self.lock:
+            if not self.connected:
+                self.draining = False
+                return
+            if self.unwritten() < self.inflight:
+                if self.spooled:
+                    rows = self.spool.execute("SELECT seq, topic, payload, kind FROM outbound ORDER BY seq LIMIT ?", (self.replay_batch,)).fetchall()
+                    if rows:
+                        self.spool.execute("DELETE FROM outbound WHERE seq <= ?", (rows[-1][0],))
+                        self.spool.commit()
+                    self.spooled -= len(rows)
+                    batch = [(topic, payload, kind) for seq, topic, payload, kind in rows]
+                while len(batch) < self.replay_batch and self.queued:
+                    topic, (payload, kind) = self.queued.popitem(last=False)
+                    batch.append((topic, payload, kind))
+        for topic, payload, kind in batch:
+            self.send(topic, payload, kind)
+        metrics.inc("thermostat_mqtt_outbound_replayed_total", value=len(batch))
+        with self.lock:
+            if self.connected and (self.queued or self.spooled):
+                call_later(OUTBOUND_REPLAY_TICK, self.drain)
+            else:
+                self.draining = False
+
+outbound = OutboundQueue(int(os.environ.get('MQTT_QUEUE_SIZE', '1000')), int(os.environ.get('MQTT_INFLIGHT', '1000')), float(os.environ.get('MQTT_REPLAY_RATE', '50')), os.environ.get('MQTT_SPOOL'))
+
+state_publisher = StatePublisher(float(os.environ.get('STATE_PUBLISH_DELAY', '0.3')))
+
+# Every valid post is handed to each sink as a sample of the monitored values it carried. MQTT is
+# always a sink, through the state publisher above. The others export samples for analytics
+# without going through Home Assistant. Each has its own bounded queue and a thread that writes
+# batches out every flush interval, or as soon as a full batch is waiting. emit only appends to
+# the queue, so a slow or unreachable consumer never holds up a reply to the thermostat. When a
+# queue is full the oldest samples are dropped. Failed batches go back on the queue and are retried
+# with backoff.
+EXPORT_MAX_BACKOFF = 60
+
+class QueuedSink:
+    name = None
+
+    def __init__(self, queue_size, flush_interval, batch_size):
+        self.queue = deque(maxlen=queue_size)
+        self.condition = threading.Condition()
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.failures = 0
+        self.closing = False
+        self.thread = threading.Thread(target=self.run, name=f"{self.name}-sink", daemon=True)
+        self.thread.start()
+
+    def emit(self, thermostat, source, sample):
+        if not sample:
+            return
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                metrics.inc("thermostat_export_samples_total", (("sink", self.name), ("result", "dropped")))
+            self.queue.append((time.time(), thermostat.serial, thermostat.name, source, sample))
+            if len(self.queue) >= self.batch_size and not self.failures:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                timeout = min(self.flush_interval * 2 ** self.failures, EXPORT_MAX_BACKOFF) if self.failures else self.flush_interval
+                self.condition.wait_for(lambda: self.closing or (not self.failures and len(self.queue) >= self.batch_size), timeout)
+                batch = [self.queue.popleft() for _ in range(min(len(self.queue), self.batch_size))]
+                closing = self.closing
+            if batch:
+                try:
+                    self.write(batch)
+                    self.failures = 0
+                    metrics.inc("thermostat_export_samples_total", (("sink", self.name), ("result", "written")), len(batch))
+                except Exception as error:
+                    self.failures += 1
+                    logging.warning(f"Exporting {len(batch)} samples to the {self.name} sink failed ({self.failures} in a row): {error}")
+                    metrics.inc("thermostat_export_samples_total", (("sink", self.name), ("result", "failed")), len(batch))
+                    if not closing:
+                        self.requeue(batch)
+            if closing and (not self.queue or self.failures):
+                return
+
+    # Back in front of anything newer, as much of it as still fits
+    def requeue(self, batch):
+        with self.condition:
+            dropped = max(0, len(batch) - (self.queue.maxlen - len(self.queue)))
+            self.queue.extendleft(reversed(batch[dropped:]))
+        if dropped:
+            metrics.inc("thermostat_export_samples_total", (("sink", self.name), ("result", "dropped")), dropped)
+
+    # Write out what is queued and stop, close_sinks waits for it
+    def stop(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+
+    def write(self, batch):
+        raise NotImplementedError
+
+# EXPORT_FILE appends samples as InfluxDB line protocol, or CSV with one row per value when
+# EXPORT_FILE_FORMAT=csv (the default for a .csv path). Past EXPORT_FILE_MAX_BYTES the file is
+# renamed to <path>.1, older ones shift up to EXPORT_FILE_BACKUPS, and a new file is started.
+CSV_HEADER = ("time", "serial", "name", "source", "field", "value")
+
+def line_protocol_tag(value):
+    return value.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+def line_protocol_value(value):
+    try:
+        number = float(value)
+        if math.isfinite(number):
+            return repr(number)
+    except ValueError:
+        pass
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+class FileSink(QueuedSink):
+    name = "file"
+
+    def __init__(self, path, format, max_bytes, backups, **settings):
+        self.path = path
+        self.format = format
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        super().__init__(**settings)
+
+    def open(self):
+        self.file = open(self.path, "a", newline="")
+        if self.format == "csv" and self.file.tell() == 0:
+            csv.writer(self.file).writerow(CSV_HEADER)
+            self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def render(self, batch):
+        if self.format == "csv":
+            text = io.StringIO()
+            writer = csv.writer(text)
+            for timestamp, serial, name, source, sample in batch:
+                moment = datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+                writer.writerows((moment, serial, name, source, field, value) for field, value in sample.items() if value is not None)
+            return text.getvalue()
+
+        lines = []
+        for timestamp, serial, name, source, sample in batch:
+            fields = ",".join(f"{line_protocol_tag(field)}={line_protocol_value(value)}" for field, value in sample.items() if value is not None)
+            if fields:
+                lines.append(f"thermostat,serial={line_protocol_tag(serial)},name={line_protocol_tag(name)},source={line_protocol_tag(source)} {fields} {int(timestamp * 1e9)}\n")
+        return "".join(lines)
+
+    def write(self, batch):
+        if self.file is None:
+            self.open()
+        self.file.write(self.render(batch))
+        self.file.flush()
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+# EXPORT_WEBHOOK=<url> POSTs each batch as a JSON array of {time, serial, name, source, fields}.
+# Any 2xx reply is success. Other 4xx replies, apart from 429, mean the receiver will never accept
+# the batch, so it is dropped rather than retried. bench/webhook_receiver.py stands in for a
+# receiver when testing.
+class WebhookSink(QueuedSink):
+    name = "webhook"
+
+    def __init__(self, url, timeout=10, **settings):
+        self.url = url
+        self.timeout = timeout
+        super().__init__(**settings)
+
+    def write(self, batch):
+        body = json.dumps([
+            {"time": round(timestamp, 3), "serial": serial, "name": name, "source": source, "fields": sample}
+            for timestamp, serial, name, source, sample in batch
+        ])
+        request = urllib.request.Request(self.url, bytes(body, "utf8"), {"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as error:
+            if 400 <= error.code < 500 and error.code != 429:
+                logging.warning(f"Webhook rejected {len(batch)} samples with {error.code}, dropping them")
+                metrics.inc("thermostat_export_samples_total", (("sink", self.name), ("result", "rejected")), len(batch))
+                return
+            raise
+
+# EXPORT_<SINK>_QUEUE_SIZE, EXPORT_<SINK>_FLUSH_INTERVAL and EXPORT_<SINK>_BATCH_SIZE per sink
+def sink_settings(prefix, flush_interval):
+    return {
+        "queue_size": int(os.environ.get(f"{prefix}_QUEUE_SIZE", "10000")),
+        "flush_interval": float(os.environ.get(f"{prefix}_FLUSH_INTERVAL", flush_interval)),
+        "batch_size": int(os.environ.get(f"{prefix}_BATCH_SIZE", "500")),
+    }
+
+# The export sinks run threads, so they are only started once the process is done forking, and
+# with WORKERS only in the coordinator
+sinks = [state_publisher]
+
+def start_sinks():
+    if os.environ.get('EXPORT_FILE'):
+        export_file = os.environ['EXPORT_FILE']
+        sinks.append(FileSink(
+            export_file,
+            os.environ.get('EXPORT_FILE_FORMAT', "csv" if export_file.endswith(".csv") else "line"),
+            int(os.environ.get('EXPORT_FILE_MAX_BYTES', '10485760')),
+            int(os.environ.get('EXPORT_FILE_BACKUPS', '5')),
+            **sink_settings("EXPORT_FILE", "5")))
+    if os.environ.get('EXPORT_WEBHOOK'):
+        sinks.append(WebhookSink(os.environ['EXPORT_WEBHOOK'], **sink_settings("EXPORT_WEBHOOK", "10")))
+
+def export(thermostat, source, received_message):
+    sample = {option: received_message[option] for option in MONITORED if option in received_message}
+    for sink in sinks:
+        sink.emit(thermostat, source, sample)
+
+# Flush every export sink at shutdown, giving up after timeout seconds in total
+def close_sinks(timeout=5):
+    exporters = [sink for sink in sinks if isinstance(sink, QueuedSink)]
+    for sink in exporters:
+        sink.stop()
+    deadline = time.monotonic() + timeout
+    for sink in exporters:
+        sink.thread.join(max(0, deadline - time.monotonic()))
+
+# Home Assistant discovery entities published alongside each climate device as
+# (component, object id, payload). Names and unique ids are prefixed with the thermostat's
+# name and serial, and every payload gets the device and state topic.
+DISCOVERY_ENTITIES = [
+    ("binary_sensor", "changes-pending", {"name": "Changes Pending", "ic": "mdi:sync", "val_tpl": "{{ value_json.changes_pending }}", "uniq_id": "changes-pending", "device_class": "update"}),
+    ("sensor", "latest-equip", {"name": "Active Equipment Event", "ic": "mdi:alert", "val_tpl": "{{ value_json.latest_equip }}", "uniq_id": "latest-equip"}),
+    ("sensor", "temp", {"name": "Temperature", "unit_of_meas": "°F", "device_class": "temperature", "ic": "mdi:thermometer", "val_tpl": "{{ value_json.rt }}", "uniq_id": "temp"}),
+    ("sensor", "humidity", {"name": "Humidity", "unit_of_meas": "%", "device_class": "humidity", "ic": "mdi:water-percent", "val_tpl": "{{ value_json.rh }}", "uniq_id": "humidity"}),
+    ("sensor", "mode", {"name": "Operating Mode", "ic": "mdi:home-thermometer", "val_tpl": "{{ value_json.mode }}", "uniq_id": "mode"}),
+    ("sensor", "fan-mode", {"name": "Fan Mode", "val_tpl": "{{ value_json.fan }}", "ic": "mdi:fan", "uniq_id": "fan-mode"}),
+    ("sensor", "state", {"name": "State", "ic": "mdi:home-thermometer", "val_tpl": "{% if value_json.coolicon == 'on' %}Cooling{% elif value_json.heaticon == 'on' %}Heating{% elif value_json.fanicon == 'on' %}Idle Fan{% elif value_json.coolicon == 'off' and value_json.heaticon == 'off' and value_json.fanicon == 'off' %}Idle{% else %}Unknown{% endif %}", "uniq_id": "state"}),
+    ("sensor", "setpoint", {"name": "Setpoint", "ic": "mdi:thermometer", "val_tpl": "{% if value_json.mode == 'cool' %}{{ value_json.clsp }}{% elif value_json.mode == 'heat' %}{{ value_json.htsp }}{% endif %}", "uniq_id": "setpoint", "unit_of_meas": "°F", "device_class": "temperature"}),
+    ("sensor", "fan-status", {"name": "Fan Status", "val_tpl": "{{ value_json.fanicon }}", "ic": "mdi:fan", "uniq_id": "fanicon"}),
+    ("sensor", "hold", {"name": "Hold", "val_tpl": "{{ value_json.hold }}", "ic": "mdi:gesture-tap-hold", "uniq_id": "hold"}),
+    ("sensor", "filtrlvl", {"name": "Filter Hours Remain", "ic": "mdi:clock", "val_tpl": "{{ value_json.filtrlvl }}", "uniq_id": "filtrlvl", "unit_of_meas": "h", "device_class": "duration"}),
+    ("sensor", "oducoiltmp", {"name": "Outdoor Coil Temperature", "ic": "mdi:hvac", "val_tpl": "{{ value_json.oducoiltmp }}", "uniq_id": "oducoiltmp", "unit_of_meas": "°F", "device_class": "temperature"}),
+    ("sensor", "oat", {"name": "Outdoor Ambient Temperature", "ic": "mdi:thermometer", "val_tpl": "{{ value_json.oat }}", "uniq_id": "oat", "unit_of_meas": "°F", "device_class": "temperature"}),
+    ("sensor", "iducfm", {"name": "Indoor CFM", "ic": "mdi:fan", "val_tpl": "{{ value_json.iducfm }}", "uniq_id": "iducfm", "unit_of_meas": "cfm"}),
+    ("sensor", "last-time", {"val_tpl": "{{ value_json.last_communication }}", "name": "Last Communication", "ic": "mdi:clock", "uniq_id": "last-time", "device_class": "timestamp"}),
+]
+
+DISCOVERY_SYNC_GRACE = 1
+
+# Discovery payloads are serialized once and only published when the retained copy on the broker
+# is missing or different. The retained copies are learned by subscribing to our own config topics
+# on connect, which replaces republishing every entity on every reconnect.
+class DiscoveryRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.payloads = {}
+        self.retained = {}
+        self.pending_subscriptions = set()
+        self.generation = 0
+        self.synced = False
+        self.unbuilt = []
+
+    # Payloads are only built once MQTT connects, which keeps them out of startup.
+    # They are built from the thermostat's current state, so nothing from before is lost.
+    def register(self, thermostat):
+        with self.lock:
+            self.unbuilt.append(thermostat)
+
+    def build(self):
+        with self.lock:
+            unbuilt, self.unbuilt = self.unbuilt, []
+        updates = {}
+        for thermostat in unbuilt:
+            for topic, payload in thermostat.discovery_payloads().items():
+                updates[topic] = (payload, hashlib.sha1(bytes(payload, "utf8")).digest())
+        with self.lock:
+            self.payloads.update(updates)
+
+    def update(self, payloads):
+        updates = {}
+        for topic, payload in payloads.items():
+            updates[topic] = (payload, hashlib.sha1(bytes(payload, "utf8")).digest())
+        with self.lock:
+            self.payloads.update(updates)
+            synced = self.synced
+        if synced:
+            self.publish_changed(updates)
+
+    def connected(self, client):
+        self.build()
+        with self.lock:
+            self.generation += 1
+            self.synced = False
+            self.retained.clear()
+            self.pending_subscriptions.clear()
+            topics = list(self.payloads)
+        for offset in range(0, len(topics), 100):
+            result, mid = client.subscribe([(topic, 0) for topic in topics[offset:offset + 100]])
+            if result == mqttClient.MQTT_ERR_SUCCESS:
+                self.pending_subscriptions.add(mid)
+
+    # Updates made while disconnected wait for the sync after the next connect
+    def disconnected(self):
+        with self.lock:
+            self.synced = False
+
+    def on_subscribe(self, mid):
+        if mid not in self.pending_subscriptions:
+            return
+        self.pending_subscriptions.discard(mid)
+        if not self.pending_subscriptions:
+            # Retained messages follow the SUBACK, give them a moment to arrive
+            generation = self.generation
+            call_later(DISCOVERY_SYNC_GRACE, lambda: self.sync(generation))
+
+    def on_retained(self, topic, payload):
+        if not payload:
+            self.retained.pop(topic, None)
+            return
+        self.retained[topic] = hashlib.sha1(payload).digest()
+        if topic.startswith("homeassistant/climate/") and topic.endswith("-climate/config"):
+            thermostat = thermostats.get(topic.split("/")[2][:-len("-climate")])
+            if thermostat is None:
+                return
+            # Anything unreadable keeps just its digest, so the sync replaces it with our payload
+            try:
+                retained_configuration = json.loads(payload)
+            except ValueError:
+                logging.warning(f"Ignoring unreadable retained {topic}")
+                return
+            device = retained_configuration.get("device") if isinstance(retained_configuration, dict) else None
+            if isinstance(device, dict) and thermostat.adopt_device(device):
+                thermostat.publish_climate_configuration()
+
+    def sync(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.synced = True
+            payloads = dict(self.payloads)
+        published = self.publish_changed(payloads)
+        logging.info(f'Published {published} of {len(payloads)} Config Entries')
+
+    def publish_changed(self, payloads):
+        published = 0
+        for topic, (payload, digest) in payloads.items():
+            if self.retained.get(topic) == digest:
+                continue
+            if mqtt_publish(topic, payload, "discovery"):
+                self.retained[topic] = digest
+                published += 1
+        return published
+
+discovery = DiscoveryRegistry()
+
+# Fleet mode: THERMOSTATS=serial:name,serial:name serves many thermostats from one process.
+# Otherwise fall back to the single THERMOSTAT_SERIAL / THERMOSTAT_NAME pair.
+def parse_thermostats():
+    if os.environ.get('THERMOSTATS'):
+        entries = []
+        for entry in os.environ['THERMOSTATS'].split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            serial, _, name = entry.partition(":")
+            entries.append((serial.strip(), name.strip() or serial.strip()))
+        return entries
+    return [(os.environ['THERMOSTAT_SERIAL'], os.environ['THERMOSTAT_NAME'])]
+
+thermostats = {}
+thermostats_by_name = {}
+stored_snapshots = state_store.load()
+for serial, name in parse_thermostats():
+    thermostats[serial] = thermostats_by_name[name] = Thermostat(serial, name)
+    if serial in stored_snapshots:
+        thermostats[serial].restore(stored_snapshots[serial])
+        logging.info(f"Restored state for {name}")
+    discovery.register(thermostats[serial])
+
+# Thermostats request /systems/<serial>/<resource>. A lone thermostat answers regardless
+# of the serial in the path, as it always has.
+def thermostat_for_path(path):
+    parts = urlparse(path).path.split("/")
+    if "systems" in parts:
+        index = parts.index("systems") + 1
+        if index < len(parts) and parts[index] in thermostats:
+            return thermostats[parts[index]]
+    if len(thermostats) == 1:
+        return next(iter(thermostats.values()))
+    return None
 
 def on_connect(client, userdata, flags, reason_code, properties):
     if reason_code == 0:
         logging.info("Connected to MQTT")
     else:
         return 
+    outbound.on_connect()
 
-    client.subscribe(f"{thermostat_command_topic}/#")
-    logging.info(f'''Subscribed to {thermostat_command_topic}/#''')
+    if len(thermostats) == 1:
+        command_topic = f"{next(iter(thermostats.values())).command_topic}/#"
+    else:
+        command_topic = "homeassistant/climate/+/cmnd/#"
+    client.subscribe(command_topic)
+    logging.info(f'''Subscribed to {command_topic}''')
 
-    client.publish(f'homeassistant/climate/{thermostat_serial}-climate/config', json.dumps(climate_configuration_payload), retain=True)
+    state_publisher.forget()
 
-    changes_pending_sensor_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Changes Pending",
-        "ic": "mdi:sync",
-        "val_tpl": "{{ value_json.changes_pending }}",
-        "uniq_id": f"{thermostat_serial}-changes-pending",
-        "device_class": "update"
-    }
-    client.publish(f'homeassistant/binary_sensor/{thermostat_serial}-changes-pending/config', json.dumps(changes_pending_sensor_payload), retain=True)
-
-    latest_equipment_event_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Active Equipment Event",
-        "ic": "mdi:alert",
-        "val_tpl": "{{ value_json.latest_equip }}",
-        "uniq_id": f"{thermostat_serial}-latest-equip"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-latest-equip/config', json.dumps(latest_equipment_event_payload), retain=True)
-
-    temperature_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Temperature",
-        "unit_of_meas": "°F",
-        "device_class": "temperature",
-        "ic": "mdi:thermometer",
-        "val_tpl": "{{ value_json.rt }}",
-        "uniq_id": f"{thermostat_serial}-temp"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-temp/config', json.dumps(temperature_sensor_configuration_payload), retain=True)
-
-    humidity_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Humidity",
-        "unit_of_meas": "%",
-        "device_class": "humidity",
-        "ic": "mdi:water-percent",
-        "val_tpl": "{{ value_json.rh }}",
-        "uniq_id": f"{thermostat_serial}-humidity"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-humidity/config', json.dumps(humidity_sensor_configuration_payload), retain=True)
-
-    mode_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Operating Mode",
-        "ic": "mdi:home-thermometer",
-        "val_tpl": "{{ value_json.mode }}",
-        "uniq_id": f"{thermostat_serial}-mode"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-mode/config', json.dumps(mode_sensor_configuration_payload), retain=True)
-
-    fan_mode_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Fan Mode",
-        "val_tpl": "{{ value_json.fan }}",
-        "ic": "mdi:fan",
-        "uniq_id": f"{thermostat_serial}-fan-mode"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-fan-mode/config', json.dumps(fan_mode_sensor_configuration_payload), retain=True)
-
-    state_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} State",
-        "ic": "mdi:home-thermometer",
-        "val_tpl": "{% if value_json.coolicon == 'on' %}Cooling{% elif value_json.heaticon == 'on' %}Heating{% elif value_json.fanicon == 'on' %}Idle Fan{% elif value_json.coolicon == 'off' and value_json.heaticon == 'off' and value_json.fanicon == 'off' %}Idle{% else %}Unknown{% endif %}",
-        "uniq_id": f"{thermostat_serial}-state"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-state/config', json.dumps(state_sensor_configuration_payload), retain=True)
-
-    setpoint_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Setpoint",
-        "ic": "mdi:thermometer",
-        "val_tpl": "{% if value_json.mode == 'cool' %}{{ value_json.clsp }}{% elif value_json.mode == 'heat' %}{{ value_json.htsp }}{% endif %}",
-        "uniq_id": f"{thermostat_serial}-setpoint",
-        "unit_of_meas": "°F",
-        "device_class": "temperature"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-setpoint/config', json.dumps(setpoint_sensor_configuration_payload), retain=True)
-
-    fanicon_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Fan Status",
-        "val_tpl": "{{ value_json.fanicon }}",
-        "ic": "mdi:fan",
-        "uniq_id": f"{thermostat_serial}-fanicon"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-fan-status/config', json.dumps(fanicon_sensor_configuration_payload), retain=True)
-
-    hold_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Hold",
-        "val_tpl": "{{ value_json.hold }}",
-        "ic": "mdi:gesture-tap-hold",
-        "uniq_id": f"{thermostat_serial}-hold"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-hold/config', json.dumps(hold_sensor_configuration_payload), retain=True)
-
-    filtrlvl_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Filter Hours Remain",
-        "ic": "mdi:clock",
-        "val_tpl": "{{ value_json.filtrlvl }}",
-        "uniq_id": f"{thermostat_serial}-filtrlvl",
-        "unit_of_meas": "h",
-        "device_class": "duration"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-filtrlvl/config', json.dumps(filtrlvl_sensor_configuration_payload), retain=True)
-
-    oducoiltmp_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Outdoor Coil Temperature",
-        "ic": "mdi:hvac",
-        "val_tpl": "{{ value_json.oducoiltmp }}",
-        "uniq_id": f"{thermostat_serial}-oducoiltmp",
-        "unit_of_meas": "°F",
-        "device_class": "temperature"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-oducoiltmp/config', json.dumps(oducoiltmp_sensor_configuration_payload), retain=True)
-
-    oat_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Outdoor Ambient Temperature",
-        "ic": "mdi:thermometer",
-        "val_tpl": "{{ value_json.oat }}",
-        "uniq_id": f"{thermostat_serial}-oat",
-        "unit_of_meas": "°F",
-        "device_class": "temperature"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-oat/config', json.dumps(oat_sensor_configuration_payload), retain=True)
-
-    iducfm_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "name": f"{thermostat_name} Indoor CFM",
-        "ic": "mdi:fan",
-        "val_tpl": "{{ value_json.iducfm }}",
-        "uniq_id": f"{thermostat_serial}-iducfm",
-        "unit_of_meas": "cfm"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-iducfm/config', json.dumps(iducfm_sensor_configuration_payload), retain=True)
-
-    last_time_sensor_configuration_payload = {
-        "device": device,
-        "stat_t": thermostat_state_topic,
-        "val_tpl": "{{ value_json.last_communication }}",
-        "name": f"{thermostat_name} Last Communication",
-        "ic": "mdi:clock",
-        "uniq_id": f"{thermostat_serial}-last-time",
-        "device_class": "timestamp"
-    }
-    client.publish(f'homeassistant/sensor/{thermostat_serial}-last-time/config', json.dumps(last_time_sensor_configuration_payload), retain=True)
+    discovery.connected(client)
 
-    logging.info('Published Config Entries')
+def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
+    logging.warning(f"Disconnected from MQTT: {reason_code}")
+    outbound.on_disconnect()
+    discovery.disconnected()
+
+def on_connect_fail(client, userdata):
+    logging.warning("MQTT connect failed, retrying")
+
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    discovery.on_subscribe(mid)
 
 def on_message(client, userdata, message):
-    global changes_pending
-    global candidate_configuration
-    global current_configuration
+    if message.topic.endswith("/config"):
+        discovery.on_retained(message.topic, message.payload)
+        return
+
     message.payload = message.payload.decode("utf-8")
     logging.info(f'''New message: {message.topic} {message.payload}''')
 
-    if message.topic == f"{thermostat_command_topic}/operating_mode":
-        new_operating_mode = message.payload
-        changes_pending = True
-        candidate_configuration["mode"] = new_operating_mode
+    # homeassistant/climate/<name>/cmnd/<command>
+    topic = message.topic.split("/")
+    if len(topic) != 5 or topic[3] != "cmnd" or topic[2] not in thermostats_by_name:
+        return
+    thermostat = thermostats_by_name[topic[2]]
+    command = topic[4]
+    metrics.inc("thermostat_mqtt_commands_total", (("command", command),))
 
-    elif message.topic == f"{thermostat_command_topic}/fan_mode":
-        new_fan_mode = message.payload
-        changes_pending = True
-        candidate_configuration["fan"] = new_fan_mode
+    if thermostat.commands.submit(command, message.payload):
+        thermostat.publish_state()
 
-    elif message.topic == f"{thermostat_command_topic}/hold":
-        new_hold_mode = message.payload
-        changes_pending = True
-        candidate_configuration["hold"] = new_hold_mode
+XML_CONTENT_TYPE = "application/xml; charset=utf-8"
+TEXT_CONTENT_TYPE = "text/plain; charset=utf-8"
 
-    elif message.topic == f"{thermostat_command_topic}/temperature":
-        new_temperature = message.payload
+# Replies are complete HTTP responses, headers included, so either engine sends them in one write.
+# Everything but the timestamp, Date header and config fields is encoded once and reused.
+REPLY_HEAD = bytes(f"HTTP/1.1 200 OK\r\nServer: {BaseHTTPRequestHandler.server_version} {BaseHTTPRequestHandler.sys_version}\r\nDate: ", "latin-1")
+reply_heads = {}
 
-        if 'clsp' in candidate_configuration:
-            if candidate_configuration['mode'] == "cool" and new_temperature != candidate_configuration['clsp']:
-                changes_pending = True
-                candidate_configuration["clsp"] = new_temperature.split(".")[0]
+# (second, timestamp, Date header) shared by every reply rendered within that second
+clock_cache = (None, None, None)
 
-        if 'htsp' in candidate_configuration:
-            if candidate_configuration['mode'] == "heat" and new_temperature != candidate_configuration['htsp']:
-                changes_pending = True
-                candidate_configuration["htsp"] = new_temperature.split(".")[0]
+def clock():
+    global clock_cache
+    now = int(time.time())
+    if clock_cache[0] != now:
+        clock_cache = (now, bytes(time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)), "ascii"), bytes(formatdate(now, usegmt=True), "ascii"))
+    return clock_cache
 
-    if changes_pending:
-        current_configuration["changes_pending"] = "ON"
-        client.publish(thermostat_state_topic, str(current_configuration).replace("'", '"').replace("None", '""'), retain=True)
+def render_head(length, content_type):
+    head = f"\r\nContent-Length: {length}\r\nConnection: keep-alive\r\n"
+    if content_type is not None:
+        head += f"Content-Type: {content_type}\r\n"
+    return bytes(head + "\r\n", "latin-1")
+
+# Template replies only come in a handful of lengths, so their header blocks are cached. Replies of
+# arbitrary length (JSON, metrics) pass cache_head=False so the cache can't grow without bound.
+def render_reply(body_parts, content_type=None, cache_head=True):
+    length = sum(map(len, body_parts))
+    if not cache_head:
+        head = render_head(length, content_type)
+    else:
+        key = (length, content_type)
+        head = reply_heads.get(key)
+        if head is None:
+            head = reply_heads[key] = render_head(length, content_type)
+    return b"".join((REPLY_HEAD, clock()[2], head) + tuple(body_parts))
+
+def empty_reply():
+    # Send 0 length 200 response
+    return render_reply(())
+
+class ReplyTemplates:
+    def __init__(self, serial):
+        status = f'''<status version="1.9" xmlns:atom="http://www.w3.org/2005/Atom"><atom:link rel="self" href="http://{api_server_address}/systems/{serial}/status"/><atom:link rel="http://{api_server_address}/rels/system" href="http://{api_server_address}/systems/{serial}"/><timestamp>'''
+        self.status_prefix = bytes(status, "utf8")
+        self.status_suffix = bytes('''</pingRate><dealerConfigPingRate>0</dealerConfigPingRate><weatherPingRate>14400</weatherPingRate><equipEventsPingRate>60</equipEventsPingRate><historyPingRate>86400</historyPingRate><iduFaultsPingRate>86400</iduFaultsPingRate><iduStatusPingRate>86400</iduStatusPingRate><oduFaultsPingRate>86400</oduFaultsPingRate><oduStatusPingRate>0</oduStatusPingRate><configHasChanges>off</configHasChanges><dealerConfigHasChanges>off</dealerHasChanges><dealerHasChanges>off</dealerHasChanges><oduConfigHasChanges>off</oduConfigHasChanges><iduConfigHasChanges>off</iduConfigHasChanges><utilityEventsHasChanges>off</utilityEventsHasChanges></status>''', "utf8")
+        self.change_notice_suffix = bytes('''</pingRate><dealerConfigPingRate>0</dealerConfigPingRate><weatherPingRate>14400</weatherPingRate><equipEventsPingRate>60</equipEventsPingRate><historyPingRate>86400</historyPingRate><iduFaultsPingRate>86400</iduFaultsPingRate><iduStatusPingRate>86400</iduStatusPingRate><oduFaultsPingRate>86400</oduFaultsPingRate><oduStatusPingRate>0</oduStatusPingRate><configHasChanges>on</configHasChanges><dealerConfigHasChanges>off</dealerConfigHasChanges><dealerHasChanges>off</dealerHasChanges><oduConfigHasChanges>off</oduConfigHasChanges><iduConfigHasChanges>off</iduConfigHasChanges><utilityEventsHasChanges>off</utilityEventsHasChanges></status>''', "utf8")
+
+        config = f'''<config version="1.9" xmlns:atom="http://www.w3.org/2005/Atom"><atom:link rel="self" href="http://{api_server_address}/systems/{serial}/config"/><atom:link rel="http://{api_server_address}/rels/system" href="http://{api_server_address}/systems/{serial}"/><atom:link rel="http://{api_server_address}/rels/dealer_config" href="http://{api_server_address}/systems/{serial}/dealer_config"/><timestamp>'''
+        self.config_prefix = bytes(config, "utf8")
+        self.config_fields = [bytes(fragment, "utf8") for fragment in (
+            '''</timestamp><mode>''',
+            '''</mode><fan>''',
+            '''</fan><blight>10</blight><timeFormat>12</timeFormat><dst>on</dst><volume>high</volume><soundType>click</soundType><scrLockout>off</scrLockout><scrLockoutCode>0000</scrLockoutCode><humSetpoint>45</humSetpoint><dehumSetpoint>45</dehumSetpoint><utilityEvent/><zones><zone id="1"><name>Zone 1</name><hold>''',
+            '''</hold><otmr/><htsp>''',
+            '''</htsp><clsp>''',
+        )]
+        self.config_suffix = bytes('''</clsp><program></program></zone></zones></config>''', "utf8")
+        # (values, rendered bytes) of the last configuration sent
+        self.config_body = (None, b"")
+
+PING_RATE_PREFIX = b'''</timestamp><pingRate>'''
+
+reply_templates = {}
+
+def templates_for(thermostat):
+    if thermostat.serial not in reply_templates:
+        reply_templates[thermostat.serial] = ReplyTemplates(thermostat.serial)
+    return reply_templates[thermostat.serial]
+
+# Adaptive pingRate, off unless PING_RATE_FAST is set. While changes are pending, and for
+# PING_RATE_HOLD seconds after the last command, the thermostat is asked to poll every
+# PING_RATE_FAST seconds so follow-up commands land quickly. After that the rate doubles every
+# hold period until it reaches PING_RATE_IDLE, where 0 leaves polling to the thermostat.
+class PingRateScheduler:
+    def __init__(self, fast, idle, hold):
+        self.fast = fast
+        self.idle = idle
+        self.hold = max(hold, 1)
+        self.encoded = {}
+
+    def ping_rate(self, thermostat):
+        if not self.fast:
+            return self.idle
+        if thermostat.changes_pending:
+            return self.fast
+        last_command = thermostat.commands.last_command
+        if last_command is None:
+            return self.idle
+        periods = int((time.monotonic() - last_command) // self.hold)
+        if periods == 0:
+            return self.fast
+        if self.idle == 0:
+            return 0
+        return min(self.fast << min(periods, 16), self.idle)
+
+    def encode(self, thermostat):
+        rate = self.ping_rate(thermostat)
+        if rate not in self.encoded:
+            self.encoded[rate] = bytes(f"{rate}", "utf8")
+        return self.encoded[rate]
+
+ping_rates = PingRateScheduler(int(os.environ.get('PING_RATE_FAST', '0')), int(os.environ.get('PING_RATE_IDLE', '0')), int(os.environ.get('PING_RATE_HOLD', '120')))
+
+def status_reply(thermostat):
+    templates = templates_for(thermostat)
+    return render_reply((templates.status_prefix, clock()[1], PING_RATE_PREFIX, ping_rates.encode(thermostat), templates.status_suffix), XML_CONTENT_TYPE)
+
+def change_notice_reply(thermostat):
+    templates = templates_for(thermostat)
+    return render_reply((templates.status_prefix, clock()[1], PING_RATE_PREFIX, ping_rates.encode(thermostat), templates.change_notice_suffix), XML_CONTENT_TYPE)
+
+TIME_PREFIX = bytes(f'''<time version="1.9" xmlns:atom="http://www.w3.org/2005/Atom"><atom:link rel="self" href="http://{api_server_address}/time/"/><utc>''', "utf8")
+TIME_SUFFIX = b'''</utc></time>'''
+
+def time_reply():
+    return render_reply((TIME_PREFIX, clock()[1], TIME_SUFFIX), XML_CONTENT_TYPE)
+
+JSON_CONTENT_TYPE = "application/json"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def json_reply(document):
+    return render_reply((bytes(json.dumps(document), "utf8"),), JSON_CONTENT_TYPE, cache_head=False)
+
+def alive_reply():
+    return render_reply((b"alive",), TEXT_CONTENT_TYPE)
+
+# Everything after the timestamp only changes with the configuration, so it is rendered once per change
+def config_reply(thermostat, configuration):
+    templates = templates_for(thermostat)
+    values = tuple(configuration[field] for field in CONFIG_FIELDS)
+    rendered_values, body = templates.config_body
+    if values != rendered_values:
+        parts = []
+        for fragment, value in zip(templates.config_fields, values):
+            parts.append(fragment)
+            parts.append(bytes(f"{value}", "utf8"))
+        parts.append(templates.config_suffix)
+        body = b"".join(parts)
+        templates.config_body = (values, body)
+    return render_reply((templates.config_prefix, clock()[1], body), XML_CONTENT_TYPE)
+
+MONITORED = ["rt","rh","mode","fan","coolicon","heaticon","fanicon","hold","filtrlvl","clsp","htsp","opstat","iducfm","oat","oducoiltmp"]
+EQUIPMENT_EVENT_TAGS = {"active", "localtime", "description"}
+
+# We only need data from these paths, and only these tags from each
+wanted_tags = {
+    "/status": set(MONITORED),
+    "/odu_status": set(MONITORED),
+    "/equipment_events": set(MONITORED) | EQUIPMENT_EVENT_TAGS,
+    "/profile": set(MONITORED) | {"firmware"},
+    "/idu_faults": set(),
+    "/odu_faults": set(),
+    "/history": set(),
+}
+
+# Uploads whose entries are also kept in full in the event store, by the source name they are stored under
+EVENT_SOURCES = {"/equipment_events": "equipment_events", "/idu_faults": "idu_faults", "/odu_faults": "odu_faults", "/history": "history"}
+
+# Stream the document through a pull parser, keeping the text of wanted tags and dropping each
+# element once it has closed. Equipment events arrive newest first, so with latest_event_only
+# parsing stops as soon as the element holding the first event closes.
+#
+# Given on_records, every element below the root whose children are all leaves is also a record
+# of (context, fields, inherited): the tag path from the root, the element's attributes plus the
+# text of each leaf, and the leaf fields of its ancestors to fall back on for a timestamp. Records
+# are handed to on_records in batches of up to EVENT_BATCH_SIZE as the document streams past, so
+# a large upload never holds more than one batch. Fault and history uploads aren't documented
+# beyond being lists of such entries, so nothing more specific is assumed. Collecting records
+# reads the whole document.
+EVENT_BATCH_SIZE = 500
+
+def parse_message(chunks, wanted, latest_event_only=False, on_records=None):
+    parser = ET.XMLPullParser(("start", "end"))
+    received_message = {}
+    open_elements = []
+    # Per open element, the text of its leaf children and whether any child had children of its own
+    open_fields = []
+    records = []
+    event_depth = None
+    collecting = True
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == "start":
+                open_elements.append(element)
+                open_fields.append([{}, False])
+                continue
+
+            open_elements.pop()
+            depth = len(open_elements)
+            fields, nested = open_fields.pop()
+            if on_records is not None and depth:
+                if not fields and not nested:
+                    open_fields[-1][0].setdefault(element.tag, element.text or "")
+                else:
+                    open_fields[-1][1] = True
+                    if not nested:
+                        context = "/".join([parent.tag for parent in open_elements[1:]] + [element.tag])
+                        records.append((context, dict(element.attrib, **fields), [inherited for inherited, _ in open_fields]))
+                        if len(records) >= EVENT_BATCH_SIZE:
+                            on_records(records)
+                            records = []
+
+            if collecting and element.tag in wanted:
+                if not latest_event_only:
+                    received_message[element.tag] = element.text
+                elif element.tag not in received_message:
+                    received_message[element.tag] = element.text
+                    if element.tag in EQUIPMENT_EVENT_TAGS and event_depth is None:
+                        event_depth = depth - 1
+            elif collecting and latest_event_only and depth == event_depth:
+                if on_records is None:
+                    return received_message
+                collecting = False
+
+            if open_elements:
+                del open_elements[-1][:]
+
+    parser.close()
+    if records:
+        on_records(records)
+    return received_message
+
+def text_chunks(data, chunk_size=16384):
+    for offset in range(0, len(data), chunk_size):
+        yield data[offset:offset + chunk_size]
+
+# Telemetry history kept in process: per thermostat and metric a ring of raw samples plus
+# downsampled tiers of (min, max, avg) buckets. Timestamps are uint32 epoch seconds and values
+# float32, so a full metric costs a fixed few tens of KB however long the server runs.
+HISTORY_METRICS = ["rt", "rh", "oat", "oducoiltmp", "iducfm", "filtrlvl", "clsp", "htsp"]
+
+class RingBuffer:
+    def __init__(self, capacity, fields):
+        self.capacity = capacity
+        self.times = array("I", bytes(4 * capacity))
+        self.fields = [array("f", bytes(4 * capacity)) for _ in fields]
+        self.start = 0
+        self.count = 0
+
+    def append(self, timestamp, *values):
+        index = (self.start + self.count) % self.capacity
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.count += 1
+        self.times[index] = timestamp
+        for field, value in zip(self.fields, values):
+            field[index] = value
+
+    # Until it wraps the ring holds everything ever recorded
+    def covers(self, timestamp):
+        return self.count < self.capacity or self.times[self.start] <= timestamp
+
+    # First logical position with a timestamp >= timestamp
+    def bisect(self, timestamp):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[(self.start + middle) % self.capacity] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def range(self, start, end):
+        rows = []
+        for position in range(self.bisect(start), self.bisect(end + 1)):
+            index = (self.start + position) % self.capacity
+            rows.append((self.times[index],) + tuple(field[index] for field in self.fields))
+        return rows
+
+class DownsampledTier:
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.buckets = RingBuffer(capacity, ("min", "max", "avg"))
+        self.bucket = None
+
+    def add(self, timestamp, value):
+        bucket_start = timestamp - timestamp % self.resolution
+        if self.bucket is not None and self.bucket[0] != bucket_start:
+            self.close()
+        if self.bucket is None:
+            self.bucket = [bucket_start, value, value, 0.0, 0]
+        bucket = self.bucket
+        bucket[1] = min(bucket[1], value)
+        bucket[2] = max(bucket[2], value)
+        bucket[3] += value
+        bucket[4] += 1
+
+    def close(self):
+        bucket_start, minimum, maximum, total, count = self.bucket
+        self.buckets.append(bucket_start, minimum, maximum, total / count)
+        self.bucket = None
+
+    def range(self, start, end):
+        rows = self.buckets.range(start, end)
+        # Include the bucket still filling up
+        if self.bucket is not None and start <= self.bucket[0] <= end:
+            bucket_start, minimum, maximum, total, count = self.bucket
+            rows.append((bucket_start, minimum, maximum, total / count))
+        return rows
+
+class Series:
+    def __init__(self, capacity, tiers):
+        self.raw = RingBuffer(capacity, ("value",))
+        self.tiers = [DownsampledTier(resolution, tier_capacity) for resolution, tier_capacity in tiers]
+
+    def add(self, timestamp, value):
+        self.raw.append(timestamp, value)
+        for tier in self.tiers:
+            tier.add(timestamp, value)
+
+    # Raw samples unless asked otherwise or they no longer reach back to start, then the finest tier that does
+    def select(self, start, resolution):
+        if resolution is None:
+            if self.raw.covers(start) or not self.tiers:
+                return None
+            for tier in self.tiers:
+                if tier.buckets.covers(start):
+                    return tier
+            return self.tiers[-1]
+        for tier in self.tiers:
+            if tier.resolution == resolution:
+                return tier
+        return None
+
+class History:
+    def __init__(self, capacity, tiers):
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.tiers = tiers
+        self.series = {}
+
+    def record(self, serial, received_message, timestamp=None):
+        if self.capacity <= 0:
+            return
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        with self.lock:
+            for metric in HISTORY_METRICS:
+                try:
+                    value = float(received_message[metric])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                key = (serial, metric)
+                if key not in self.series:
+                    self.series[key] = Series(self.capacity, self.tiers)
+                self.series[key].add(timestamp, value)
+
+    def query(self, serial, metric, start, end, resolution=None):
+        with self.lock:
+            series = self.series.get((serial, metric))
+            if series is None:
+                return None
+            tier = series.select(start, resolution)
+            if tier is None:
+                points = [[timestamp, value] for timestamp, value in series.raw.range(start, end)]
+                values = [point[1] for point in points]
+                minimums = maximums = values
+                resolution = 0
+            else:
+                points = [list(row) for row in tier.range(start, end)]
+                values = [point[3] for point in points]
+                minimums = [point[1] for point in points]
+                maximums = [point[2] for point in points]
+                resolution = tier.resolution
+        return {
+            "serial": serial,
+            "metric": metric,
+            "start": start,
+            "end": end,
+            "resolution": resolution,
+            "count": len(points),
+            "min": min(minimums) if points else None,
+            "max": max(maximums) if points else None,
+            "avg": sum(values) / len(values) if points else None,
+            "points": points,
+        }
+
+# HISTORY_TIERS=<seconds>:<buckets>,... defaults to a week of 5 minute and eight weeks of hourly buckets
+def parse_history_tiers(tiers):
+    parsed = []
+    for tier in tiers.split(","):
+        if tier.strip():
+            resolution, _, capacity = tier.partition(":")
+            parsed.append((int(resolution), int(capacity)))
+    return sorted(parsed)
+
+history = History(int(os.environ.get('HISTORY_CAPACITY', '2880')), parse_history_tiers(os.environ.get('HISTORY_TIERS', '300:2016,3600:1344')))
+
+# GET /api/history/<serial>/<metric>?start=<epoch>&end=<epoch>&resolution=<seconds>, default the last day
+def history_reply(path):
+    url = urlparse(path)
+    parts = url.path.split("/")
+    if len(parts) != 5:
+        return empty_reply()
+    query = parse_qs(url.query)
+    try:
+        end = int(query["end"][0]) if "end" in query else int(time.time())
+        start = int(query["start"][0]) if "start" in query else end - 86400
+        resolution = int(query["resolution"][0]) if "resolution" in query else None
+    except ValueError:
+        return empty_reply()
+    result = history.query(parts[3], parts[4], start, end, resolution)
+    if result is None:
+        return empty_reply()
+    return json_reply(result)
+
+# Equipment events, faults and history uploads kept in full. Thermostats resend the same entries
+# with every upload, so each is stored once per serial, source, context, time and code, and only
+# rewritten when something about it changed, e.g. an event going inactive. Entries with neither a
+# time nor a code are keyed by a digest of their fields instead.
+# EVENT_STORE=/path/to/events.db persists them, EVENT_MAX_ROWS caps the table, dropping the oldest.
+EVENT_TIME_FIELDS = ("localtime", "localTime", "time", "timestamp", "date", "datetime")
+EVENT_CODE_FIELDS = ("code", "faultcode", "errorcode")
+EVENT_PAGE_LIMIT = 1000
+
+# A record's own time, else its nearest ancestor's. Equipment event times come as T<ISO 8601>.
+def event_time(fields, inherited):
+    for candidates in [fields] + inherited[::-1]:
+        for name in EVENT_TIME_FIELDS:
+            if candidates.get(name):
+                return candidates[name].lstrip("T")
+    return ""
+
+class EventStore:
+    def __init__(self, path, max_rows):
+        self.lock = threading.Lock()
+        self.max_rows = max_rows
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, serial TEXT NOT NULL, source TEXT NOT NULL, "
+            "context TEXT NOT NULL, time TEXT NOT NULL, code TEXT NOT NULL, fingerprint TEXT NOT NULL, active TEXT, description TEXT, "
+            "record TEXT NOT NULL, received REAL NOT NULL, UNIQUE (serial, source, context, time, code, fingerprint))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS events_by_time ON events (serial, time, id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS events_by_code ON events (serial, code, time, id)")
+        self.rows = self.connection.execute("SELECT count(*) FROM events").fetchone()[0]
+
+    def add(self, serial, source, records):
+        received = time.time()
+        rows = []
+        for context, fields, inherited in records:
+            # Equipment event ids are positions in the upload and shift as new events arrive
+            fields.pop("id", None)
+            record = json.dumps(fields, sort_keys=True)
+            timestamp = event_time(fields, inherited)
+            code = next((fields[name] for name in EVENT_CODE_FIELDS if fields.get(name)), "")
+            fingerprint = "" if timestamp or code else hashlib.sha1(bytes(record, "utf8")).hexdigest()
+            rows.append((serial, source, context, timestamp, code, fingerprint, fields.get("active"), fields.get("description"), record, received))
+
+        with self.lock:
+            self.connection.execute("BEGIN")
+            changes = self.connection.total_changes
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO events (serial, source, context, time, code, fingerprint, active, description, record, received) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            inserted = self.connection.total_changes - changes
+            if inserted < len(rows):
+                changes = self.connection.total_changes
+                self.connection.executemany(
+                    "UPDATE events SET active = ?, description = ?, record = ?, received = ? WHERE serial = ? AND source = ? "
+                    "AND context = ? AND time = ? AND code = ? AND fingerprint = ? AND record != ?",
+                    [row[6:] + row[:6] + row[8:9] for row in rows])
+                updated = self.connection.total_changes - changes
+            else:
+                updated = 0
+            self.rows += inserted
+            if self.max_rows and self.rows > self.max_rows:
+                self.connection.execute("DELETE FROM events WHERE id IN (SELECT id FROM events ORDER BY id LIMIT ?)", (self.rows - self.max_rows,))
+                self.rows = self.max_rows
+            self.connection.execute("COMMIT")
+
+        metrics.inc("thermostat_events_stored_total", (("source", source), ("result", "inserted")), inserted)
+        metrics.inc("thermostat_events_stored_total", (("source", source), ("result", "updated")), updated)
+        metrics.inc("thermostat_events_stored_total", (("source", source), ("result", "duplicate")), len(rows) - inserted - updated)
+        if inserted:
+            logging.debug(f"Stored {inserted} new {source} entries for {serial}")
+
+    # Newest first, cursor is the (time, id) of the last entry on the previous page
+    def query(self, serial, source=None, code=None, start=None, end=None, limit=100, cursor=None):
+        clauses, parameters = ["serial = ?"], [serial]
+        if source is not None:
+            clauses.append("source = ?")
+            parameters.append(source)
+        if code is not None:
+            clauses.append("code = ?")
+            parameters.append(code)
+        if start is not None:
+            clauses.append("time >= ?")
+            parameters.append(start)
+        if end is not None:
+            clauses.append("time < ?")
+            parameters.append(end)
+        if cursor is not None:
+            clauses.append("(time < ? OR (time = ? AND id < ?))")
+            parameters.extend((cursor[0], cursor[0], cursor[1]))
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, source, context, time, code, active, description, record, received FROM events "
+                f"WHERE {' AND '.join(clauses)} ORDER BY time DESC, id DESC LIMIT ?", parameters + [limit + 1]).fetchall()
+
+        entries = [
+            {"source": source, "context": context, "time": timestamp, "code": code, "active": active, "description": description,
+             "record": json.loads(record), "received": round(received, 3)}
+            for _, source, context, timestamp, code, active, description, record, received in rows[:limit]
+        ]
+        following = f"{rows[limit - 1][3]}|{rows[limit - 1][0]}" if len(rows) > limit else None
+        return {"serial": serial, "events": entries, "next": following}
+
+events = EventStore(os.environ.get('EVENT_STORE', ':memory:'), int(os.environ.get('EVENT_MAX_ROWS', '100000')))
+
+# Workers rebind this to forward batches to the coordinator, which owns the store
+def store_events(serial, source, records):
+    events.add(serial, source, records)
+
+# GET /api/events/<serial>?source=&code=&start=&end=&limit=&cursor=, newest first. start and end
+# compare against the thermostat's ISO 8601 times as strings, end is exclusive. Pass next from a
+# reply as cursor for the following page.
+def events_reply(path):
+    url = urlparse(path)
+    parts = url.path.split("/")
+    if len(parts) != 4 or not parts[3]:
+        return empty_reply()
+    query = parse_qs(url.query)
+    try:
+        limit = int(query["limit"][0]) if "limit" in query else 100
+        cursor = None
+        if "cursor" in query:
+            timestamp, _, row = query["cursor"][0].rpartition("|")
+            cursor = (timestamp, int(row))
+    except ValueError:
+        return empty_reply()
+    if limit < 1:
+        return empty_reply()
+    filters = {name: query[name][0] for name in ("source", "code", "start", "end") if name in query}
+    return json_reply(events.query(parts[3], limit=min(limit, EVENT_PAGE_LIMIT), cursor=cursor, **filters))
+
+def handle_request(command, path, data, client_ip):
+    started = time.perf_counter()
+    if command == "POST":
+        reply = handle_post(path, data, client_ip)
+    else:
+        reply = handle_get(path)
+    count_request(command, path, len(data) if data else 0, len(reply), time.perf_counter() - started)
+    return reply
+
+def count_request(command, path, received_bytes, sent_bytes, seconds):
+    label = path_label(path)
+    metrics.inc("thermostat_http_requests_total", (("method", command), ("path", label)))
+    metrics.observe("thermostat_http_request_duration_seconds", (("path", label),), seconds)
+    if received_bytes:
+        metrics.inc("thermostat_http_received_bytes_total", value=received_bytes)
+    metrics.inc("thermostat_http_sent_bytes_total", value=sent_bytes)
+
+def metrics_reply():
+    now = time.time()
+    for thermostat in thermostats.values():
+        labels = (("serial", thermostat.serial), ("name", thermostat.name))
+        if thermostat.last_seen is not None:
+            metrics.set("thermostat_last_seen_seconds", labels, round(now - thermostat.last_seen, 3))
+        metrics.set("thermostat_changes_pending", labels, int(thermostat.changes_pending))
+        metrics.set("thermostat_ping_rate_seconds", labels, ping_rates.ping_rate(thermostat))
+    metrics.set("thermostat_mqtt_publish_queue_depth", value=outbound.unwritten())
+    metrics.set("thermostat_mqtt_outbound_queued", value=len(outbound.queued))
+    metrics.set("thermostat_mqtt_outbound_spooled", value=outbound.spooled)
+    metrics.set("thermostat_state_publish_pending", value=len(state_publisher.pending))
+    metrics.set("thermostat_events_rows", value=events.rows)
+    for sink in sinks:
+        if isinstance(sink, QueuedSink):
+            metrics.set("thermostat_export_queued", (("sink", sink.name),), len(sink.queue))
+    return render_reply((bytes(metrics.render(), "utf8"),), METRICS_CONTENT_TYPE, cache_head=False)
+
+def handle_get(path):
+    if path.startswith("/api/history/"):
+        return history_reply(path)
+
+    elif path.startswith("/api/events/"):
+        return events_reply(path)
+
+    elif path == "/metrics":
+        return metrics_reply()
+
+    elif "/Alive" in path:
+        return alive_reply()
+
+    elif "/time" in path:
+        return time_reply()
+
+    elif "/config" in path and thermostat_for_path(path) is not None:
+        thermostat = thermostat_for_path(path)
+        configuration, version = thermostat.commands.take()
+        if configuration is None:
+            logging.warning(f"{thermostat.name} fetched /config before reporting its settings")
+            return empty_reply()
+        logging.info(f'''New configuration for {thermostat.name} (version {version}): {configuration}''')
+        reply = config_reply(thermostat, configuration)
+        thermostat.publish_state()
+        return reply
+
+    return empty_reply()
+
+# Thermostat XML arrives fully percent-encoded, and nearly all of its escapes are these few.
+# bytes.replace handles them in C, and unquote only sees whatever is left. None of the
+# replacements are hex digits or %, so they can't combine with their neighbours into a new escape.
+FORM_ESCAPES = [(bytes(f"%{ord(char):02X}", "ascii"), bytes(char, "ascii")) for char in '<>/=": ']
+FORM_ESCAPES += [(escape.lower(), char) for escape, char in FORM_ESCAPES if escape.lower() != escape]
+
+def unquote_form(body):
+    if b"%" in body:
+        for escape, char in FORM_ESCAPES:
+            body = body.replace(escape, char)
+        if b"%" in body:
+            body = unquote_to_bytes(body)
+    return body
+
+def decode_form(body):
+    return str(unquote_form(body), "utf8", "replace").strip("data=")
+
+# Decodes an upload a chunk at a time for the pull parser, which takes UTF-8 bytes as they come.
+# A chunk never ends inside a %XX escape.
+def form_chunks(body, chunk_size=16384):
+    view = memoryview(body)
+    offset = len(body) - len(body.lstrip(b"data="))
+    while offset < len(body):
+        end = offset + chunk_size
+        if end < len(body):
+            escape = body.rfind(b"%", end - 2, end)
+            if escape > offset:
+                end = escape
+        yield unquote_form(bytes(view[offset:end]))
+        offset = end
+
+def handle_post(path, data, client_ip):
+    return apply_post(path, client_ip, *parse_post(path, data))
+
+# Decoding and parsing touch no state, so with WORKERS they run in the worker processes.
+# Returns (final_locator, received_message, parse_seconds), received_message is None if malformed.
+def parse_post(path, data):
+    final_locator = f'/{path.split("/")[-1:][0]}' # eg /status
+    if thermostat_for_path(path) is None:
+        return final_locator, None, 0
+
+    # Uploads can be large, so they are decoded and parsed in chunks and never held decoded in full.
+    # Their entries go to the event store batch by batch while parsing, which isn't counted as parse time.
+    if final_locator in EVENT_SOURCES:
+        logging.debug(f"{final_locator} -- {len(data)} bytes")
+        if len(data) < 45:
+            return final_locator, None, 0
+        serial = thermostat_for_path(path).serial
+        storing = [0]
+        def on_records(records):
+            started = time.perf_counter()
+            store_events(serial, EVENT_SOURCES[final_locator], records)
+            storing[0] += time.perf_counter() - started
+        try:
+            started = time.perf_counter()
+            received_message = parse_message(form_chunks(data), wanted_tags[final_locator], latest_event_only="/equipment_events" in final_locator, on_records=on_records)
+            return final_locator, received_message, time.perf_counter() - started - storing[0]
+        except:
+            return final_locator, None, 0
+
+    data = decode_form(data)
+    logging.debug(f"{final_locator} -- {data}")
+
+    # Malformed message
+    if len(data) < 45 or final_locator not in wanted_tags:
+        return final_locator, None, 0
+
+    try: 
+        # Parse and create dict of received message
+        started = time.perf_counter()
+        received_message = parse_message(text_chunks(data), wanted_tags[final_locator])
+        return final_locator, received_message, time.perf_counter() - started
+    except:
+        return final_locator, None, 0
+
+# Serials that posted without being configured, so each is only warned about once
+unknown_serials = set()
+
+def apply_post(path, client_ip, final_locator, received_message, parse_seconds):
+    thermostat = thermostat_for_path(path)
+    if thermostat is None:
+        parts = urlparse(path).path.split("/")
+        serial = parts[parts.index("systems") + 1] if "systems" in parts[:-1] else ""
+        if serial in unknown_serials:
+            logging.debug(f"Ignoring {path} from unknown thermostat")
+        else:
+            unknown_serials.add(serial)
+            logging.warning(f"Ignoring {path} from unknown thermostat, add its serial to THERMOSTATS to serve it")
+        return empty_reply()
+    current_configuration = thermostat.current_configuration
+    thermostat.last_seen = time.time()
+    reply = None
+
+    if received_message is None:
+        if "/status" in path:
+            return status_reply(thermostat)
+        return empty_reply()
+    metrics.observe("thermostat_xml_parse_duration_seconds", (("path", final_locator),), parse_seconds)
+
+    # Build current_configuration with monitored variables
+    for option in MONITORED:
+        if option in received_message:
+            current_configuration[option] = received_message[option]
+    history.record(thermostat.serial, received_message)
+
+    # We don't need any kind of response for this path
+    if "/odu_status" in final_locator:
+        pass
+
+    elif "/equipment_events" in final_locator:
+        # Fix for some newer firmware versions
+        if "active" in received_message and received_message['active'] == "on":
+            state = f"{received_message['localtime'][1:]}: {received_message['description']}"
+        else:
+            state = "No Active Event"
+        current_configuration["latest_equip"] = state
+
+    elif "/profile" in final_locator:
+        # Attempt to grab FW version and update climate device
+        try:
+            if thermostat.device["sw"] != received_message['firmware']:
+                thermostat.device["sw"] = f"{received_message['firmware']}"
+                thermostat.publish_climate_configuration()
+        except:
+            pass
+
+    elif "/status" in final_locator:
+        logging.debug(f"Current Configuration: {current_configuration}")
+        current_configuration["last_communication"] = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        thermostat.commands.reported(current_configuration)
+
+        if thermostat.first_start == True:
+            # Update climate device with client IP
+            thermostat.device["cns"] = [["ip", client_ip]]
+            thermostat.publish_climate_configuration()
+
+            thermostat.first_start = False
+            reply = change_notice_reply(thermostat) if thermostat.changes_pending else status_reply(thermostat)
+
+        elif thermostat.changes_pending == True:
+            logging.info(f"Responding with change notice to {thermostat.name}...")
+            reply = change_notice_reply(thermostat)
+
+        else:
+            reply = status_reply(thermostat)
+
+    # Update MQTT topic with current states and hand the sample to any other sinks
+    export(thermostat, final_locator[1:], received_message)
+    return reply if reply is not None else empty_reply()
+
+# Both engines parse request heads by hand. Thermostats send a few short headers and only
+# Content-Length matters, so http.client's email based header parsing is skipped.
+NOT_IMPLEMENTED_REPLY = b"HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+def parse_request_line(line):
+    words = line.split()
+    if len(words) != 3 or not words[2].startswith(b"HTTP/"):
+        return None, None
+    return str(words[0], "latin-1"), str(words[1], "latin-1")
+
+def parse_content_length(line):
+    if line[:15].lower() == b"content-length:":
+        return int(line[15:])
+    return None
 
 class MyHttpRequestHandler(BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
 
+    # Per request logging is debug only, it costs more than handling a /status poll
     def log_message(self, format, *args):
-        logging.info(f"{self.address_string()} -- {self.command} -- {self.path}")
-
-    def send_no_changes(self):
-        html = f'''<status version="1.9" xmlns:atom="http://www.w3.org/2005/Atom"><atom:link rel="self" href="http://{api_server_address}/systems/{thermostat_serial}/status"/><atom:link rel="http://{api_server_address}/rels/system" href="http://{api_server_address}/systems/{thermostat_serial}"/><timestamp>{datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}</timestamp><pingRate>0</pingRate><dealerConfigPingRate>0</dealerConfigPingRate><weatherPingRate>14400</weatherPingRate><equipEventsPingRate>60</equipEventsPingRate><historyPingRate>86400</historyPingRate><iduFaultsPingRate>86400</iduFaultsPingRate><iduStatusPingRate>86400</iduStatusPingRate><oduFaultsPingRate>86400</oduFaultsPingRate><oduStatusPingRate>0</oduStatusPingRate><configHasChanges>off</configHasChanges><dealerConfigHasChanges>off</dealerHasChanges><dealerHasChanges>off</dealerHasChanges><oduConfigHasChanges>off</oduConfigHasChanges><iduConfigHasChanges>off</iduConfigHasChanges><utilityEventsHasChanges>off</utilityEventsHasChanges></status>'''
-        self.send_response(200)
-        self.send_header("Content-Length", str(len(html)))
-        self.send_header("Connection", "keep-alive")
-        self.send_header("Content-Type", "application/xml; charset=utf-8")
-        self.end_headers()
+        logging.debug(f"{self.address_string()} -- {self.command} -- {self.path}")
+
+    # Replaces BaseHTTPRequestHandler's parse_request and do_* dispatch, handle() still loops
+    # over this until close_connection is set
+    def handle_one_request(self):
+        self.close_connection = True
+        try:
+            self.requestline = self.rfile.readline(65537)
+            self.command, self.path = parse_request_line(self.requestline)
+            if self.command is None:
+                return
+
+            length = 0
+            while True:
+                line = self.rfile.readline(65537)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                header_length = parse_content_length(line)
+                if header_length is not None:
+                    length = header_length
+
+            if self.command == "GET":
+                data = None
+            elif self.command == "POST":
+                data = self.rfile.read(length)
+            else:
+                self.wfile.write(NOT_IMPLEMENTED_REPLY)
+                return
+        except (TimeoutError, ValueError):
+            return
+        self.send_reply(handle_request(self.command, self.path, data, self.client_address[0]))
+
+    def send_reply(self, reply):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            self.log_request(200)
+        self.close_connection = False
         try:
-            self.wfile.write(bytes(html, "utf8"))
-            self.wfile.flush()
+            self.wfile.write(reply)
         except BrokenPipeError:
             self.log_error("Client closed connection before response was sent")
 
-    def send_empty_200(self):
-        self.send_response(200)
-        self.send_header("Content-Length", "0")
-        self.send_header("Connection", "keep-alive")
-        self.end_headers()
-
-    def do_GET(self):
-        if "/Alive" in self.path:
-            html = "alive"
-            self.send_response(200)
-            self.send_header("Content-Length", "5")
-            self.send_header("Connection", "keep-alive")
-            self.send_header("Content-Type", "text/plain; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(bytes(html, "utf8"))
-
-        elif "/time" in self.path:
-            time = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-            html = f'''<time version="1.9" xmlns:atom="http://www.w3.org/2005/Atom"><atom:link rel="self" href="http://{api_server_address}/time/"/><utc>{time}</utc></time>'''
-            self.send_response(200)
-            self.send_header("Content-Length", len(html))
-            self.send_header("Connection", "keep-alive")
-            self.send_header("Content-Type", "application/xml; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(bytes(html, "utf8"))
-
-        elif "/config" in self.path:
-            global changes_pending
-            global current_configuration
-            changes_pending = False
-            current_configuration["changes_pending"] = "OFF"
-            logging.info(f'''New configuration: {candidate_configuration}''')
-            html = f'''<config version="1.9" xmlns:atom="http://www.w3.org/2005/Atom"><atom:link rel="self" href="http://{api_server_address}/systems/{thermostat_serial}/config"/><atom:link rel="http://{api_server_address}/rels/system" href="http://{api_server_address}/systems/{thermostat_serial}"/><atom:link rel="http://{api_server_address}/rels/dealer_config" href="http://{api_server_address}/systems/{thermostat_serial}/dealer_config"/><timestamp>{datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}</timestamp><mode>{candidate_configuration["mode"]}</mode><fan>{candidate_configuration["fan"]}</fan><blight>10</blight><timeFormat>12</timeFormat><dst>on</dst><volume>high</volume><soundType>click</soundType><scrLockout>off</scrLockout><scrLockoutCode>0000</scrLockoutCode><humSetpoint>45</humSetpoint><dehumSetpoint>45</dehumSetpoint><utilityEvent/><zones><zone id="1"><name>Zone 1</name><hold>{candidate_configuration["hold"]}</hold><otmr/><htsp>{candidate_configuration["htsp"]}</htsp><clsp>{candidate_configuration["clsp"]}</clsp><program></program></zone></zones></config>'''
-            self.send_response(200)
-            self.send_header("Content-Length", len(html))
-            self.send_header("Connection", "keep-alive")
-            self.send_header("Content-Type", "application/xml; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(bytes(html, "utf8"))
-            client.publish(thermostat_state_topic, str(current_configuration).replace("'", '"').replace("None", '""'), retain=True)
+# Handler threads sit in keep-alive reads for as long as a thermostat stays connected, so they must
+# not keep the process alive once the server is asked to stop
+class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
 
-        else:
-            # Send 0 length 200 response
-            self.send_empty_200()
-
-    def do_POST(self):
-        data = self.rfile.read(int(self.headers.get('Content-length'))).decode("utf-8")
-        data = unquote(data).strip("data=")
-        global current_configuration
-        global candidate_configuration
-        global first_start
-
-        html = ""
-        match = False
-        monitored = ["rt","rh","mode","fan","coolicon","heaticon","fanicon","hold","filtrlvl","clsp","htsp","opstat","iducfm","oat","oducoiltmp"]
-        paths = ["/status", "/odu_status","/equipment_events", "/profile"] # we only need data from these paths
-        received_message = {}
-        final_locator = f'/{self.path.split("/")[-1:][0]}' # eg /status
-        logging.debug(f"{final_locator} -- {data}")
-
-        if len(data) >= 45 and final_locator in paths:
-            try: 
-                # Parse and create dict of received message
-                root = ET.fromstring(data)
-                children = list(root)
-                if "/equipment_events" in final_locator:
-                    for child in root.iter():
-                        # Only get latest equipment event
-                        if child.tag in received_message:
-                            continue
-                        else:
-                            received_message[child.tag] = child.text
-                else:
-                    for child in root.iter():
-                        received_message[child.tag] = child.text
-            except:
-                if "/status" in self.path:
-                    self.send_no_changes()
-                else:
-                    self.send_empty_200()
+# socketserver only grew allow_reuse_port in 3.11
+class ReusePortServer(ThreadingSimpleServer):
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+# Asyncio engine (SERVER_MODE=asyncio): every keep-alive connection is a coroutine on one
+# event loop rather than an OS thread, and paho is driven from the same loop.
+async def handle_connection(reader, writer):
+    client_ip = writer.get_extra_info("peername")[0]
+    try:
+        while True:
+            # The whole head in one read rather than a readline per header
+            lines = (await reader.readuntil(b"\r\n\r\n")).split(b"\r\n")
+            command, path = parse_request_line(lines[0])
+            if command is None:
+                break
+
+            length = 0
+            try:
+                for line in lines[1:]:
+                    header_length = parse_content_length(line)
+                    if header_length is not None:
+                        length = header_length
+            except ValueError:
+                break
+
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug(f"{client_ip} -- {command} -- {path}")
+            if command == "GET":
+                reply = handle_request(command, path, None, client_ip)
+            elif command == "POST":
+                reply = handle_request(command, path, await reader.readexactly(length), client_ip)
+            else:
+                writer.write(NOT_IMPLEMENTED_REPLY)
+                break
+
+            writer.write(reply)
+            await writer.drain()
+    # asyncio.run cancels connections still waiting for a request when the server stops
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+class AsyncioMqttHelper:
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    # paho's connect blocks until the broker answers or times out, so check the broker is
+    # reachable with a non-blocking connection first and keep the loop serving meanwhile
+    async def connect(self):
+        delay = 1
+        while True:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(mqtt_address, mqtt_port), 5)
+                writer.close()
+                self.client.connect(mqtt_address, mqtt_port)
                 return
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.warning(f"MQTT connect failed: {e!r}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
 
-            # Build current_configuration with monitored variables
-            for option in monitored:
-                if option in received_message:
-                    current_configuration[option] = received_message[option]
+    # First connect, keepalives and reconnects, which loop_start() would otherwise do on its own thread
+    async def misc_loop(self):
+        while True:
+            if self.client.loop_misc() == mqttClient.MQTT_ERR_NO_CONN:
+                await self.connect()
+                continue
+            await asyncio.sleep(1)
 
-            # We don't need any kind of response for this path
-            if "/odu_status" in final_locator:
-                self.send_empty_200()
+async def serve_asyncio(worker=False):
+    global call_later
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
 
-            elif "/equipment_events" in final_locator:
-                # Fix for some newer firmware versions
-                if "active" in received_message and received_message['active'] == "on":
-                    state = f"{received_message['localtime'][1:]}: {received_message['description']}"
-                else:
-                    state = "No Active Event"
-                current_configuration["latest_equip"] = state
-                self.send_empty_200()
+    server = await asyncio.start_server(handle_connection, '0.0.0.0', 8080, reuse_address=True, reuse_port=worker or None)
+    report_listening()
 
-            elif "/profile" in final_locator:
-                # Attempt to grab FW version and update climate device
-                try:
-                    if climate_configuration_payload["device"]["sw"] != received_message['firmware']:
-                        climate_configuration_payload["device"]["sw"] = f"{received_message['firmware']}"
-                        client.publish(f'homeassistant/climate/{thermostat_serial}-climate/config', json.dumps(climate_configuration_payload), retain=True)
-                except:
-                    pass
-                self.send_empty_200()
-
-            elif "/status" in final_locator:
-                logging.debug(f"Current Configuration: {current_configuration}")
-                current_configuration["last_communication"] = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-
-                # Initialize candidate_configuration as current_configuration at first start
-                if first_start == True:
-                    candidate_configuration['clsp'] = current_configuration['clsp']
-                    candidate_configuration['htsp'] = current_configuration['htsp']
-                    candidate_configuration['mode'] = current_configuration['mode']
-
-                    # Update climate device with client IP
-                    climate_configuration_payload["device"]["cns"] = [["ip", self.client_address[0]]]
-                    client.publish(f'homeassistant/climate/{thermostat_serial}-climate/config', json.dumps(climate_configuration_payload), retain=True)
-                
-                    first_start = False
-                    self.send_no_changes()
-
-                elif changes_pending == True:
-                    logging.info("Responding with change notice...")
-                    html = f'''<status version="1.9" xmlns:atom="http://www.w3.org/2005/Atom"><atom:link rel="self" href="http://{api_server_address}/systems/{thermostat_serial}/status"/><atom:link rel="http://{api_server_address}/rels/system" href="http://{api_server_address}/systems/{thermostat_serial}"/><timestamp>{datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}</timestamp><pingRate>0</pingRate><dealerConfigPingRate>0</dealerConfigPingRate><weatherPingRate>14400</weatherPingRate><equipEventsPingRate>60</equipEventsPingRate><historyPingRate>86400</historyPingRate><iduFaultsPingRate>86400</iduFaultsPingRate><iduStatusPingRate>86400</iduStatusPingRate><oduFaultsPingRate>86400</oduFaultsPingRate><oduStatusPingRate>0</oduStatusPingRate><configHasChanges>on</configHasChanges><dealerConfigHasChanges>off</dealerConfigHasChanges><dealerHasChanges>off</dealerHasChanges><oduConfigHasChanges>off</oduConfigHasChanges><iduConfigHasChanges>off</iduConfigHasChanges><utilityEventsHasChanges>off</utilityEventsHasChanges></status>'''
-                    self.send_response(200)
-                    self.send_header("Content-Length", str(len(html)))
-                    self.send_header("Connection", "keep-alive")
-                    self.send_header("Content-Type", "application/xml; charset=utf-8")
-                    self.end_headers()
-                    self.wfile.write(bytes(html, "utf8"))
+    misc = None
+    if not worker:
+        # Deferred publishes must run on the loop too, paho is not driven from any other thread here
+        call_later = lambda delay, callback: loop.call_soon_threadsafe(loop.call_later, delay, callback)
 
-                else:
-                    self.send_no_changes()
+        helper = AsyncioMqttHelper(loop, client)
+        logging.info("Connecting to MQTT")
+        misc = asyncio.ensure_future(helper.misc_loop())
 
-            # Update MQTT topic with current states
-            client.publish(thermostat_state_topic, str(current_configuration).replace("'",'"').replace("None",'""'), retain=True)
+    async with server:
+        await stop
+    if misc is not None:
+        misc.cancel()
 
-        # Malformed message
-        else:
-            if "/status" in self.path:
-                self.send_no_changes()
+# Worker pool (WORKERS=<n>): this process becomes a coordinator that owns MQTT and all thermostat
+# state, and n forked workers share port 8080 with SO_REUSEPORT. Workers decode and parse, which
+# is most of the CPU per request, then make one call to the coordinator's state service to apply
+# the result and render the reply, plus one per batch of event store entries in an upload. The service is a facade over the same functions the single
+# process engines call, run on the manager's per connection threads. /time and /Alive need no
+# state and are answered by the workers, whose counts for them ride along with the next call.
+class StateService:
+    def get(self, path, counted=()):
+        count_requests(counted)
+        return handle_request("GET", path, None, None)
 
-            else:
-                # Send 0 length 200 response
-                self.send_empty_200()
+    def post(self, path, client_ip, received_bytes, parsed, parse_elapsed, counted=()):
+        count_requests(counted)
+        started = time.perf_counter()
+        reply = apply_post(path, client_ip, *parsed)
+        count_request("POST", path, received_bytes, len(reply), parse_elapsed + time.perf_counter() - started)
+        return reply
 
-class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
+    def store_events(self, serial, source, records):
+        events.add(serial, source, records)
+
+def count_requests(counted):
+    for request in counted:
+        count_request(*request)
+
+class StateManager(BaseManager):
     pass
 
+StateManager.register("state", StateService)
+
+def run_worker(address, authkey):
+    global handle_request, store_events
+    # Workers hold no state worth saving, so the coordinator's SIGTERM at shutdown just ends them
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    manager = StateManager(address, authkey)
+    manager.connect()
+    state = manager.state()
+
+    # Requests answered here and not yet counted by the coordinator
+    uncounted = deque()
+
+    def take_uncounted():
+        counted = []
+        try:
+            while True:
+                counted.append(uncounted.popleft())
+        except IndexError:
+            return counted
+
+    def forward_request(command, path, data, client_ip):
+        started = time.perf_counter()
+        if command == "POST":
+            parsed = parse_post(path, data)
+            return state.post(path, client_ip, len(data), parsed, time.perf_counter() - started, take_uncounted())
+        # Same precedence as handle_get
+        if path.startswith("/api/") or path == "/metrics" or ("/Alive" not in path and "/time" not in path):
+            return state.get(path, take_uncounted())
+        reply = alive_reply() if "/Alive" in path else time_reply()
+        uncounted.append((command, path, 0, len(reply), time.perf_counter() - started))
+        return reply
+    handle_request = forward_request
+    store_events = state.store_events
+
+    if os.environ.get('SERVER_MODE', 'threading') == "asyncio":
+        # The state call blocks the loop for one local round trip
+        asyncio.run(serve_asyncio(worker=True))
+    else:
+        server = ReusePortServer(('0.0.0.0', 8080), MyHttpRequestHandler)
+        report_listening()
+        server.serve_forever()
 
-client = mqttClient.Client(mqttClient.CallbackAPIVersion.VERSION2, f"thermostat_api_server_{thermostat_serial}")
+def serve_workers(count):
+    authkey = os.urandom(32)
+    # Abstract unix socket, nothing to clean up on disk
+    address = f"\0thermostat_api_server_{os.getpid()}"
+    state_server = StateManager(address, authkey).get_server()
+
+    # Fork before any thread exists, so no worker inherits a lock held mid-operation
+    context = multiprocessing.get_context("fork")
+    workers = []
+    for index in range(count):
+        worker = context.Process(target=run_worker, args=(address, authkey), name=f"worker-{index}", daemon=True)
+        worker.start()
+        workers.append(worker)
+    logging.info(f"Started {count} workers")
+    start_sinks()
+
+    threading.Thread(target=state_server.serve_forever, daemon=True).start()
+    logging.info("Connecting to MQTT")
+    client.connect_async(mqtt_address, mqtt_port)
+    client.loop_start()
+
+    # Forking a replacement from a process full of threads isn't safe, let the container restart us
+    multiprocessing.connection.wait([worker.sentinel for worker in workers])
+    for worker in workers:
+        if not worker.is_alive():
+            logging.error(f"{worker.name} exited with {worker.exitcode}, shutting down")
+    sys.exit(1)
+
+
+client = mqttClient.Client(mqttClient.CallbackAPIVersion.VERSION2, f"thermostat_api_server_{next(iter(thermostats))}")
 if "mqtt_username" in locals():
     client.username_pw_set(username=mqtt_username,password=mqtt_password)
-server = ThreadingSimpleServer(('0.0.0.0', 8080), MyHttpRequestHandler)
 
 client.on_connect = on_connect
+client.on_subscribe = on_subscribe
+client.on_publish = on_publish
+client.on_disconnect = on_disconnect
+client.on_connect_fail = on_connect_fail
 client.on_message = on_message
-logging.info("Connecting to MQTT")
-client.connect(mqtt_address, mqtt_port)
 
-client.loop_start()
-client.subscribe(thermostat_command_topic)
-server.serve_forever()
\ No newline at end of file
+# Importing the module (e.g. from the tests) sets everything up without serving
+if __name__ == "__main__":
+    # docker stop sends SIGTERM, exit cleanly so coalesced state still gets persisted. That happens on
+    # the way out of the serving code below rather than in an atexit hook, which would only run after
+    # the interpreter has joined every non-daemon thread.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    def shutdown():
+        state_publisher.persist_pending()
+        close_sinks()
+
+    try:
+        if int(os.environ.get('WORKERS', '0')) > 0:
+            serve_workers(int(os.environ['WORKERS']))
+        elif os.environ.get('SERVER_MODE', 'threading') == "asyncio":
+            start_sinks()
+            asyncio.run(serve_asyncio())
+        else:
+            start_sinks()
+            server = ThreadingSimpleServer(('0.0.0.0', 8080), MyHttpRequestHandler)
+            report_listening()
+
+            # paho's thread connects in the background and keeps retrying, thermostats are served meanwhile
+            logging.info("Connecting to MQTT")
+            client.connect_async(mqtt_address, mqtt_port)
+            client.loop_start()
+            server.serve_forever()
+    finally:
+        shutdown()